@@ -3,7 +3,7 @@ from .capturecommand import interceptCommand
 from .fileedittraffic import FileEditTraffic
 from .id_mapping import ID_ALTERATIONS_RC_FILE
 from .config import CaptureMockReplayError, RECORD, REPLAY, REPLAY_OLD_RECORD_NEW
-from . import config, cmdlineutils
+from . import config, cmdlineutils, recordformat
 import os, sys, shutil, filecmp, subprocess, tempfile, types
 from functools import wraps
 from glob import glob
@@ -228,6 +228,13 @@ def commandline():
         shutil.rmtree(interceptDir)
     terminate()
 
+def convert_commandline(argv=None):
+    parser = cmdlineutils.create_convert_option_parser()
+    options, args = parser.parse_args(argv)
+    if len(args) != 2:
+        return parser.print_help()
+    recordformat.convert(args[0], args[1], options.format, options.compression)
+
 def texttest_is_recording():
     return int(os.getenv("TEXTTEST_CAPTUREMOCK_MODE", "0")) == RECORD or os.getenv("TEXTTEST_CAPTUREMOCK_REPLAY") is None
 
@@ -372,7 +379,7 @@ def create_map_by_timestamp(recorded_files, ignoredIndices={}):
         currText = ""
         curr_timestamp = None
         fn_timestamps = []
-        with open(fn) as f:
+        with recordformat.openFile(fn) as f:
             for line in f:
                 if line.startswith("<-") or line.startswith("->RMQ"):
                     if currText:
@@ -434,7 +441,7 @@ def add_prefixes_from_timestamp_map(data_by_timestamp, ignoredIndicesIn=None, se
 
 def get_traffic_count(rpfn):
     count = 0
-    with open(rpfn) as f:
+    with recordformat.openFile(rpfn) as f:
         for line in f:
             if line.startswith("<-"):
                 count += 1
@@ -445,7 +452,7 @@ def find_recorded_position(rpfn, text, skip):
     count = 0
     searching = False
     curr_skip = 0
-    with open(rpfn) as f:
+    with recordformat.openFile(rpfn) as f:
         for line in f:
             if searching:
                 if line.startswith("<-") or line.startswith("->"):
@@ -465,7 +472,7 @@ def find_recorded_position(rpfn, text, skip):
 
 def read_first_traffic(rpfn):
     text = ""
-    with open(rpfn) as f:
+    with recordformat.openFile(rpfn) as f:
         for line in f:
             if text and (line.startswith("->") or line.startswith("<-")):
                 return text
@@ -473,7 +480,7 @@ def read_first_traffic(rpfn):
     return text
 
 def get_text_count(rpfn, text):
-    with open(rpfn) as f:
+    with recordformat.openFile(rpfn) as f:
         return f.read().count(text)
 
 def find_replay_files(stem, replayed_files, fn):
@@ -518,7 +525,7 @@ def open_new_record_file(replay_fns, repIndex, ext):
 def transform_to_amqp_client_replay(fn, new_fn):
     writeFile = None
     active = False
-    with open(fn) as f:
+    with recordformat.openFile(fn) as f:
         for line in f:
             if line.startswith("->RMQ"):
                 if writeFile is None:
@@ -617,6 +624,7 @@ class CaptureMockDecorator(object):
                 setUpPython(self.mode, recordFile, replayFile, self.rcFiles, self.pythonAttrs)
                 interceptor = interceptPython(self.mode, recordFile, replayFile, self.rcFiles, self.pythonAttrs)
                 result = func(*funcargs, **funckw)
+                interceptor.closeRecordFile()
                 if self.mode == config.REPLAY:
                     self.checkMatching(recordFile, replayFile)
                 elif os.path.isfile(recordFile):
@@ -633,7 +641,7 @@ class CaptureMockDecorator(object):
     def fileContentsEqual(self, fn1, fn2):
         bufsize = 8*1024
         # copied from filecmp.py, adding universal line ending support
-        with open(fn1, newline=None) as fp1, open(fn2, newline=None) as fp2:
+        with recordformat.openFile(fn1, newline=None) as fp1, recordformat.openFile(fn2, newline=None) as fp2:
             while True:
                 b1 = fp1.read(bufsize)
                 b2 = fp2.read(bufsize)
@@ -0,0 +1,115 @@
+""" Applying alterations to traffic text, last added first, each as a regex.sub pass on the result of the previous one """
+import re
+from collections import OrderedDict
+
+class LiteralPattern:
+    """ Stands in for the compiled pattern of an ID mapping, which is just one string to swap for another """
+    def __init__(self, pattern):
+        self.pattern = pattern
+
+    def __eq__(self, other):
+        return isinstance(other, LiteralPattern) and self.pattern == other.pattern
+
+    def __hash__(self):
+        return hash(self.pattern)
+
+    @staticmethod
+    def canUse(pattern, replacement):
+        return not re.search(r"[.^$*+?{}\[\]\\|()]", pattern) and "\\" not in replacement and not replacement.startswith("$")
+
+
+class AlterationDict(OrderedDict):
+    """ Alterations in the order they were added, which keeps the passes needed to apply them until it changes """
+    def __init__(self, *args, **kw):
+        self.engine = None
+        super(AlterationDict, self).__init__(*args, **kw)
+
+    def __setitem__(self, key, value):
+        if key not in self or self[key] != value:
+            self.engine = None
+        super(AlterationDict, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.engine = None
+        super(AlterationDict, self).__delitem__(key)
+
+    def getEngine(self):
+        if self.engine is None:
+            self.engine = AlterationEngine(list(reversed(self.items())))
+        return self.engine
+
+
+class AlterationEngine:
+    def __init__(self, items):
+        self.passes = []
+        for regex, repl in items:
+            if isinstance(regex, LiteralPattern):
+                # Any number of ID mappings in a row are done together, in one pass
+                if not self.passes or not isinstance(self.passes[-1][0], LiteralReplacer):
+                    self.passes.append((LiteralReplacer(), None, False))
+                self.passes[-1][0].add(regex.pattern, repl)
+            else:
+                self.passes.append((regex, repl, self.needsCallback(regex, repl)))
+
+    @staticmethod
+    def needsCallback(regex, repl):
+        # Alteration variables are stored as they are found, everything else re can expand itself,
+        # which is much faster than calling back for every match
+        if repl.startswith("$"):
+            return True
+        try:
+            regex.sub(repl, "")
+            return False
+        except Exception:
+            # Bad group references etc. are only errors when something matches, keep it that way
+            return True
+
+    def apply(self, text, makeReplacer):
+        for regex, repl, needsCallback in self.passes:
+            if isinstance(regex, LiteralReplacer):
+                text = regex.sub(text)
+            else:
+                text = regex.sub(makeReplacer(repl) if needsCallback else repl, text)
+        return text
+
+
+class LiteralReplacer:
+    """ Replaces lots of strings at once. Where they overlap, the leftmost and then the longest wins """
+    def __init__(self):
+        self.replacements = {}
+        self.regex = None
+
+    def add(self, text, replacement):
+        # Applied first wins, as it would have done when applying them one by one
+        self.replacements.setdefault(text, replacement)
+        self.regex = None
+
+    def sub(self, text):
+        if self.regex is None:
+            self.regex = re.compile(self.makeTriePattern(self.replacements))
+        return self.regex.sub(self.replace, text)
+
+    def replace(self, match):
+        return self.replacements[match.group(0)]
+
+    @classmethod
+    def makeTriePattern(cls, texts):
+        # An alternation of thousands of strings is slow to scan with, sharing their prefixes makes it fast
+        trie = {}
+        for text in texts:
+            node = trie
+            for char in text:
+                node = node.setdefault(char, {})
+            node[""] = {}
+        return cls.makeNodePattern(trie)
+
+    @classmethod
+    def makeNodePattern(cls, node):
+        branches = [ re.escape(char) + cls.makeNodePattern(child) for char, child in sorted(node.items()) if char ]
+        if not branches:
+            return ""
+        pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if "" in node:
+            # Greedy, so the longer strings are tried first
+            return "(?:" + pattern + ")?" if len(branches) == 1 else pattern + "?"
+        return pattern
@@ -0,0 +1,236 @@
+""" Classic TCP and HTTP servers built on asyncio streams, which can keep lots of idle connections open cheaply.
+Requests are handed to a thread whenever they might talk to something real, only replaying with nowhere to forward to is done in the event loop """
+import asyncio, socket, sys, threading, traceback
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from capturemock import config, server, clientservertraffic
+
+
+class StreamConnection:
+    """ Looks enough like a socket, and its file, for the handlers and traffic classes to write to """
+    def __init__(self, loop, writer, data=b""):
+        self.loop = loop
+        self.writer = writer
+        self.data = data
+        self.loopThread = threading.get_ident() # always made in the event loop
+
+    def inLoop(self):
+        return threading.get_ident() == self.loopThread
+
+    def makefile(self, mode, *args):
+        return BytesIO(self.data) if "r" in mode else self
+
+    async def writeAndDrain(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def sendall(self, data):
+        data = bytes(data)
+        if self.inLoop():
+            self.writer.write(data)
+        else:
+            # Wait for it to be sent, so a slow client doesn't mean we buffer everything
+            asyncio.run_coroutine_threadsafe(self.writeAndDrain(data), self.loop).result()
+
+    def write(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def shutdown(self, how):
+        if how != socket.SHUT_RD:
+            self.call(self.writeEof)
+
+    def writeEof(self):
+        if self.writer.can_write_eof() and not self.writer.is_closing():
+            self.writer.write_eof()
+
+    def call(self, method, *args):
+        if self.inLoop():
+            method(*args)
+        else:
+            self.loop.call_soon_threadsafe(method, *args)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass # the server closes the connection when the request is done
+
+    def settimeout(self, timeout):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+
+class AsyncTrafficServer:
+    def __init__(self, address, dispatcher):
+        self.dispatcher = dispatcher
+        self.socket = socket.create_server(address, backlog=500)
+        self.requestCount = 0
+        self.loop = None
+        self.stopEvent = None
+        self.connections = {} # task -> whether it is handling a request right now
+        workerCount = dispatcher.rcHandler.getint("server_worker_threads", [ "general" ], 0)
+        self.executor = ThreadPoolExecutor(workerCount or None, thread_name_prefix="request")
+
+    @classmethod
+    def createServer(cls, address, port, dispatcher):
+        return cls((address, port), dispatcher)
+
+    def run(self):
+        asyncio.run(self.serve())
+        self.executor.shutdown(wait=True)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopEvent = asyncio.Event()
+        streamServer = await asyncio.start_server(self.handleConnection, sock=self.socket, limit=1024 * 1024)
+        await self.stopEvent.wait()
+        streamServer.close()
+        # Requests in progress are finished, connections just waiting are dropped
+        for task, busy in list(self.connections.items()):
+            if not busy:
+                task.cancel()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        await streamServer.wait_closed()
+
+    async def handleConnection(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections[task] = False
+        # asyncio only does this itself for sockets it created, responses are written in pieces
+        writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            await self.handleRequests(reader, writer)
+        except (asyncio.CancelledError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            self.handleError(writer)
+        finally:
+            del self.connections[task]
+            writer.close()
+
+    def handleError(self, writer):
+        sys.stderr.write("Exception occurred during processing of request from " + repr(writer.get_extra_info("peername")) + "\n")
+        traceback.print_exc()
+
+    def setBusy(self, busy):
+        self.connections[asyncio.current_task()] = busy
+
+    def canForward(self, traffic=None):
+        # Replayed client traffic goes to the SUT's server once it has told us where that is, including the replies to telling us
+        return clientservertraffic.ClientSocketTraffic.destination is not None or isinstance(traffic, clientservertraffic.ServerStateTraffic)
+
+    async def call(self, inLoop, method, *args):
+        if inLoop:
+            return method(*args)
+        else:
+            return await self.loop.run_in_executor(self.executor, method, *args)
+
+    def getAddress(self):
+        host, port = self.socket.getsockname()
+        return host + ":" + str(port)
+
+    def shutdown(self):
+        # Can be called from the event loop or from a request thread
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.stopEvent.set)
+
+
+class AsyncClassicTcpTrafficServer(AsyncTrafficServer):
+    getTrafficClasses = staticmethod(server.ClassicTrafficServer.getTrafficClasses)
+    sendTerminateMessage = server.ClassicTrafficServer.sendTerminateMessage
+
+    async def handleRequests(self, reader, writer):
+        # We store the order things appear in so we know what order they should go in the file
+        self.requestCount += 1
+        requestNumber = self.requestCount
+        text = (await reader.read()).decode()
+        self.setBusy(True)
+        wfile = StreamConnection(self.loop, writer)
+        self.dispatcher.diag.debug("Received incoming TCP request...\n" + text)
+        try:
+            if text.startswith("TERMINATE_SERVER"):
+                self.dispatcher.shutdown()
+            else:
+                traffic = self.dispatcher.parseTraffic(text, wfile)
+                inLoop = self.dispatcher.replayInfo.isActiveFor(traffic) and not self.canForward(traffic)
+                await self.call(inLoop, self.dispatcher.process, traffic, requestNumber)
+                self.dispatcher.diag.debug("Finished processing incoming request")
+        except config.CaptureMockReplayError as e:
+            wfile.write(("CAPTUREMOCK MISMATCH: " + str(e)).encode())
+        await writer.drain()
+
+
+class AsyncHTTPTrafficServer(AsyncTrafficServer):
+    getTrafficClasses = staticmethod(server.HTTPTrafficServer.getTrafficClasses)
+
+    @classmethod
+    def createServer(cls, address, port, dispatcher):
+        server.HTTPTrafficHandler.configure(dispatcher)
+        return cls((address, port), dispatcher)
+
+    async def handleRequests(self, reader, writer):
+        # Idle keep-alive connections cost nothing here, so they can stay open until the client or the server stops
+        while not self.stopEvent.is_set():
+            data = await self.readRequest(reader)
+            if not data:
+                return
+            self.setBusy(True)
+            connection = StreamConnection(self.loop, writer, data)
+            handler = await self.call(self.canHandleInLoop(data), AsyncHTTPTrafficHandler, connection, writer.get_extra_info("peername"), self)
+            await writer.drain()
+            if handler.close_connection:
+                return
+            self.setBusy(False)
+
+    async def readRequest(self, reader):
+        # Just enough parsing to know where the request ends, the handler does the rest
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            return # client went away before sending anything useful
+        headers = {}
+        for line in head.decode("iso-8859-1").split("\r\n")[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        if "content-length" in headers:
+            return head + await reader.readexactly(int(headers["content-length"]))
+        elif "chunked" in headers.get("transfer-encoding", ""):
+            body = b""
+            while True:
+                sizeLine = await reader.readline()
+                body += sizeLine
+                size = int(sizeLine.split(b";")[0].strip(), 16)
+                if size == 0:
+                    break
+                body += await reader.readexactly(size + 2)
+            # trailers, if any, then a blank line
+            while True:
+                line = await reader.readline()
+                body += line
+                if line in (b"\r\n", b"\n", b""):
+                    return head + body
+        return head
+
+    def canHandleInLoop(self, data):
+        # Redirects, recording and forwarding replayed client traffic all mean contacting other servers.
+        # So can our own requests, e.g. setServerLocation replays whatever the SUT's server was sent next
+        requestLine = data.split(b"\r\n", 1)[0].split()
+        if len(requestLine) > 1 and requestLine[1].startswith(b"/capturemock/"):
+            return False
+        return self.dispatcher.replayInfo.isActiveForAll() and not self.canForward() and not server.HTTPTrafficHandler.redirects
+
+    def getAddress(self):
+        return "http://" + AsyncTrafficServer.getAddress(self)
+
+    def setShutdownFlag(self):
+        self.shutdown()
+
+
+class AsyncHTTPTrafficHandler(server.HTTPTrafficHandler):
+    # Each handler gets exactly one request, the server reads the next one
+    def handle(self):
+        self.handle_one_request()
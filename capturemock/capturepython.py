@@ -240,6 +240,7 @@ class InterceptHandler:
         from . import replayinfo
         self.replayInfo = replayinfo.ReplayInfo(mode, replayFile, self.rcHandler)
         self.recordFile = recordFile
+        self.trafficHandler = None
         self.allAttrNames = self.findAttributeNames(mode, pythonAttrs)
 
     def findAttributeNames(self, mode, pythonAttrs):
@@ -274,6 +275,7 @@ class InterceptHandler:
         from .pythontraffic import PythonTrafficHandler
         trafficHandler = PythonTrafficHandler(self.replayInfo, self.recordFile, self.rcHandler,
                                               callStackChecker, self.allAttrNames)
+        self.trafficHandler = trafficHandler
         if len(fullIntercepts):
             import_handler = ImportHandler(fullIntercepts, callStackChecker, trafficHandler)
             if import_handler not in sys.meta_path:
@@ -332,7 +334,12 @@ class InterceptHandler:
         setattr(realObj, attrName, proxy)
         self.attributesIntercepted.append((realObj, attrName, origValue))
 
+    def closeRecordFile(self):
+        if self.trafficHandler:
+            self.trafficHandler.recordFileHandler.close()
+
     def resetIntercepts(self):
+        self.closeRecordFile()
         for item in sys.meta_path:
             if isinstance(item, ImportHandler):
                 item.reset()
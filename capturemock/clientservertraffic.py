@@ -1,9 +1,10 @@
 """ Traffic classes for capturing client-server interaction """
 
-import socket, sys, os
+import socket, sys, os, re, hashlib, shutil, threading
 from capturemock import traffic, encodingutils
 from urllib.request import urlopen, Request
 from urllib.error import HTTPError
+from locale import getpreferredencoding
 from capturemock.fileedittraffic import FileEditTraffic
 
 try:
@@ -144,6 +145,8 @@ class XmlRpcClientTraffic(ClientSocketTraffic):
 class HTTPClientTraffic(ClientSocketTraffic):
     headerStr = "--HEA:"
     fileContentsStr = "<File Contents for %s>"
+    payloadDigestStr = "<Payload with SHA-256 digest %s>"
+    payloadDigestRegex = re.compile("<Payload with SHA-256 digest ([0-9a-f]{64})>$")
     # Copied from https://developer.mozilla.org/en-US/docs/Glossary/Forbidden_header_name
     defaultIgnoreHeaders = [ "accept-charset", "accept-encoding", "access-control-request-headers", "access-control-request-method",
                              "connection", "content-length", "cookie", "date", "dnt", "expect", "host", "keep-alive", "origin",
@@ -183,6 +186,7 @@ class HTTPClientTraffic(ClientSocketTraffic):
                 self.payload = None
         self.checkRepeats = rcHandler.getboolean("check_repeated_calls", [ self.method ], True)
         self.allCanModify = rcHandler.getboolean("assume_all_can_modify", [ "general" ], False)
+        self.spillPayloadSize = rcHandler.getint("spill_payload_size", [ "general" ], 0)
         
     def hasRepeatsInReplay(self):
         return self.checkRepeats
@@ -228,6 +232,50 @@ class HTTPClientTraffic(ClientSocketTraffic):
             f.write(contents)
         return newFn
         
+    def shouldSpillPayload(self, payload):
+        return self.spillPayloadSize > 0 and len(payload) > self.spillPayloadSize and FileEditTraffic.recordFileEditDir
+
+    @staticmethod
+    def getSpilledPayloadName(digest):
+        return "payload_" + digest
+
+    def writeSpilledPayload(self, payload):
+        # Named by content, so identical bodies are only stored once
+        digest = hashlib.sha256(payload).hexdigest()
+        editdir = FileEditTraffic.recordFileEditDir
+        path = os.path.join(editdir, self.getSpilledPayloadName(digest))
+        if not os.path.isfile(path):
+            if not os.path.isdir(editdir):
+                os.makedirs(editdir, exist_ok=True)
+            # Other requests may be writing the same body at the same time
+            tmpPath = path + "." + str(os.getpid()) + "." + str(threading.get_ident())
+            with open(tmpPath, "wb") as f:
+                f.write(payload)
+            os.replace(tmpPath, path)
+        return digest
+
+    def getSpilledPayloadFile(self, bodyText):
+        digestMatch = self.payloadDigestRegex.match(bodyText)
+        if digestMatch:
+            filename = self.getSpilledPayloadName(digestMatch.group(1))
+            if FileEditTraffic.replayFileEditDir:
+                filepath = os.path.join(FileEditTraffic.replayFileEditDir, filename)
+                if os.path.isfile(filepath):
+                    return filepath
+            print("ERROR: Cannot find payload file named", repr(filename), "when replaying!", file=sys.stderr)
+
+    def readSpilledPayload(self, path):
+        with open(path, "rb") as f:
+            rawBytes = f.read()
+        try:
+            # Not decodeBytes: whatever isn't altered must be sent exactly as if streamed from the file
+            bodyText = rawBytes.decode(getpreferredencoding())
+        except UnicodeDecodeError:
+            return rawBytes # alterations only apply to text
+        if self.replayIdMapping:
+            bodyText = bodyText.replace(*self.replayIdMapping)
+        return self.applyAlterations(bodyText).encode(getpreferredencoding())
+
     def getBoundary(self):
         contentType = self.headers.get("Content-Type", "")
         boundaryText = self.parseVariable(contentType, "boundary")
@@ -279,17 +327,21 @@ class HTTPClientTraffic(ClientSocketTraffic):
             fnUsed = self.writeEditFile(attachmentFn, payload)
             return self.fileContentsStr % fnUsed + self.getHeaderText(headers), payload
         else:
-            body = encodingutils.decodeBytes(payload)
             headerText = self.getHeaderText(headers)
             if len(self.alterations) == 0:
-                return body + headerText, payload
+                if self.shouldSpillPayload(payload):
+                    return self.payloadDigestStr % self.writeSpilledPayload(payload) + headerText, payload
+                return encodingutils.decodeBytes(payload) + headerText, payload
             
+            body = encodingutils.decodeBytes(payload)
             newBody = self.applyAlterations(body)
-            if newBody == body:
-                return body + headerText, payload
-                
-            newPayload = encodingutils.encodeString(newBody)
-            return newBody + headerText, newPayload
+            if newBody != body:
+                body = newBody
+                payload = encodingutils.encodeString(newBody)
+
+            if self.shouldSpillPayload(payload):
+                return self.payloadDigestStr % self.writeSpilledPayload(payload) + headerText, payload
+            return body + headerText, payload
                 
     def decodePayload(self, payload):
         if payload is None:
@@ -368,12 +420,20 @@ class HTTPClientTraffic(ClientSocketTraffic):
             text = self.applyAlterations(text)
             headerDict = {}
             bodyText = self.extractHeaders(text, headerDict)
-            body = encodingutils.encodeString(bodyText)
+            headers = list(headerDict.items())
+            spilledFile = self.getSpilledPayloadFile(bodyText)
+            if spilledFile:
+                if len(self.alterations) == 0 and not self.replayIdMapping:
+                    # Sent straight from the file, no need to have it all in memory
+                    return responseClass(int(status), text, None, headers, self.responseFile, self.handler, bodyFile=spilledFile)
+                # Changed as it would have been if it had been in the replay file
+                body = self.readSpilledPayload(spilledFile)
+            else:
+                body = encodingutils.encodeString(bodyText)
             attachmentFn = self.getAttachmentFileName(headerDict)
             if attachmentFn:
                 replaceStr = (self.fileContentsStr % attachmentFn).encode()
                 body = body.replace(replaceStr, self.getFileEditContents(attachmentFn))
-            headers = list(headerDict.items())
             return responseClass(int(status), text, body, headers, self.responseFile, self.handler)
         else:
             return super(HTTPClientTraffic, self).makeResponseTraffic(rawText, responseClass, rcHandler)
@@ -404,8 +464,12 @@ class XmlRpcServerTraffic(ServerTraffic):
             return self.responseObject
         
 class HTTPServerTraffic(ServerTraffic):
-    def __init__(self, status, text, body, headers, responseFile, handler):
+    # Connection-level headers, which we have to supply ourselves when keeping the connection open
+    framingHeaders = [ "connection", "content-length", "keep-alive", "transfer-encoding" ]
+    def __init__(self, status, text, body, headers, responseFile, handler, bodyFile=None):
         self.body = body
+        self.bodyFile = bodyFile
+        self.keepAlive = False
         ServerTraffic.__init__(self, str(status) + " " + text, responseFile)
         self.status = status
         self.headers = headers
@@ -413,12 +477,16 @@ class HTTPServerTraffic(ServerTraffic):
     
     def forwardToDestination(self):
         if self.handler:
+            # Decide before the headers are sent, they can change it
+            self.keepAlive = not self.handler.close_connection
             # don't include server and date, chances are we already have them
             self.handler.send_response_only(self.status)
             for hdr, value in self.headers:
-                # Might need to handle chunked transfer, for now, just ignore it and return it as one
-                if hdr.lower() != 'access-control-allow-origin' and (hdr.lower() != "transfer-encoding" or value.lower() != "chunked"):
+                if self.shouldForwardHeader(hdr.lower(), value.lower()):
                     self.handler.send_header(hdr, value)
+            if self.keepAlive and self.hasBody():
+                # The body may not be what the server sent, so its framing can't be either
+                self.handler.send_header("Content-Length", str(self.getBodySize()))
             self.handler.send_header('Access-Control-Allow-Origin', '*')
             self.handler.send_header('Access-Control-Expose-Headers', '*')
             self.handler.end_headers()
@@ -426,13 +494,35 @@ class HTTPServerTraffic(ServerTraffic):
         # Don't close the file, the HTTP server mechanism does that for us
         return []
     
+    def shouldForwardHeader(self, hdr, value):
+        if hdr == "access-control-allow-origin":
+            return False
+        elif self.keepAlive:
+            return hdr not in self.framingHeaders
+        else:
+            # Might need to handle chunked transfer, for now, just ignore it and return it as one
+            return hdr != "transfer-encoding" or value != "chunked"
+
+    def hasBody(self):
+        return self.status >= 200 and self.status not in (204, 304)
+
+    def getBodySize(self):
+        if self.bodyFile:
+            return os.path.getsize(self.bodyFile)
+        return len(self.body) if self.body else 0
+
     def write(self, message):
         if self.responseFile:
             try:
-                self.responseFile.write(message)
+                if self.bodyFile:
+                    with open(self.bodyFile, "rb") as f:
+                        shutil.copyfileobj(f, self.responseFile)
+                else:
+                    self.responseFile.write(message)
                 self.responseFile.flush()
-                self.handler.request.shutdown(socket.SHUT_WR)
-                self.handler.request.close()
+                if not self.keepAlive:
+                    self.handler.request.shutdown(socket.SHUT_WR)
+                    self.handler.request.close()
             except OSError:
                 # The service that sent the original request is no longer listening for answers
                 # This is not necessarily a problem - we don't want to raise exceptions here
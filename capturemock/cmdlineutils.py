@@ -5,7 +5,8 @@ import optparse
 def create_option_parser():
     usage = """usage: %prog [options] <program> <program_args> ...
 
-CaptureMock command line program. Records and replays interaction defined by stuff in its rc file"""
+CaptureMock command line program. Records and replays interaction defined by stuff in its rc file.
+Record files can be converted with capturemock_convert"""
 
     parser = optparse.OptionParser(usage)
     parser.add_option("-m", "--mode", type="int", default=0,
@@ -22,3 +23,16 @@ CaptureMock command line program. Records and replays interaction defined by stu
     parser.add_option("-P", "--port", type="int", default=0,
                       help="Port to run CaptureMock on", metavar="PORT")
     return parser
+
+def create_convert_option_parser():
+    usage = """usage: %prog [options] <input_file> <output_file>
+
+Converts CaptureMock record files between the text and JSON-lines formats, and between compressions.
+The input format and compression are detected, the output ones are taken from the file name unless given"""
+
+    parser = optparse.OptionParser(usage)
+    parser.add_option("-o", "--format", choices=[ "text", "jsonl" ],
+                      help="write the output file in FORMAT, text or jsonl. Default is jsonl for .jsonl files, otherwise text", metavar="FORMAT")
+    parser.add_option("-c", "--compression", choices=[ "gzip", "bz2", "xz" ],
+                      help="compress the output file with COMPRESSION, gzip, bz2 or xz. Default is from the file extension", metavar="COMPRESSION")
+    return parser
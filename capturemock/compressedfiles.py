@@ -0,0 +1,47 @@
+""" Transparent reading and writing of compressed record and replay files """
+import os, gzip, bz2, lzma
+
+compressionModules = { "gzip" : gzip, "bz2" : bz2, "xz" : lzma }
+extensions = { ".gz" : "gzip", ".bz2" : "bz2", ".xz" : "xz" }
+magicNumbers = [ (b"\x1f\x8b", "gzip"), (b"BZh", "bz2"), (b"\xfd7zXZ\x00", "xz") ]
+
+def getCompressionFromExtension(fileName):
+    return extensions.get(os.path.splitext(fileName)[-1].lower())
+
+def detectCompression(fileName):
+    # Go by what's in the file if there is anything, otherwise by its name
+    try:
+        with open(fileName, "rb") as f:
+            header = f.read(6)
+    except OSError:
+        header = b""
+    if header:
+        for magic, compression in magicNumbers:
+            if header.startswith(magic):
+                return compression
+        return None
+    return getCompressionFromExtension(fileName)
+
+def isCompressed(fileName):
+    return detectCompression(fileName) is not None
+
+def getWriteCompression(fileName, rcHandler=None):
+    if os.path.isfile(fileName) and os.path.getsize(fileName) > 0:
+        # Appending, stick with whatever is there already
+        return detectCompression(fileName)
+    compression = getCompressionFromExtension(fileName)
+    if compression is None and rcHandler:
+        compression = rcHandler.get("record_compression", [ "general" ])
+        if compression and compression not in compressionModules:
+            raise RuntimeError("Unknown record_compression " + repr(compression) + ", must be one of " + ", ".join(compressionModules))
+    return compression or None
+
+def openFile(fileName, mode="r", compression=None, **kwargs):
+    # Compression is detected when reading and must be given when writing, unless the file name says what it is
+    if compression is None:
+        compression = detectCompression(fileName) if "r" in mode else getCompressionFromExtension(fileName)
+    if compression is None:
+        return open(fileName, mode, **kwargs)
+    if "b" not in mode and "t" not in mode:
+        mode += "t"
+    return compressionModules[compression].open(fileName, mode, **kwargs)
@@ -5,7 +5,8 @@ try:
 except ImportError: # python3
     from ConfigParser import ConfigParser
     
-import os, sys, logging.config
+import os, sys, re, threading, logging.config
+from capturemock.alterations import AlterationDict, LiteralPattern
 
 REPLAY = 0
 RECORD = 1
@@ -19,6 +20,11 @@ class RcFileHandler:
         self.parser = ConfigParser(strict=False)
         self.diag = None
         self.address = None
+        # Settings are read per request, but only change when files are added or values set
+        self.lookupCache = {}
+        self.alterationCache = {}
+        self.cacheGeneration = 0
+        self.cacheLock = threading.Lock()
         if rcFiles:
             for rcFile in rcFiles:
                 if not os.path.isfile(rcFile):
@@ -29,6 +35,29 @@ class RcFileHandler:
 
     def addFile(self, rcFile):
         self.parser.read(rcFile)
+        self.invalidateCaches()
+
+    def invalidateCaches(self):
+        with self.cacheLock:
+            self.cacheGeneration += 1
+            self.lookupCache.clear()
+            self.alterationCache.clear()
+
+    def getKnownSections(self, sections):
+        # Sections can be per-traffic, e.g. a Python call with its arguments. The ones that don't exist change nothing,
+        # leaving them out keeps the cache down to what the rc files mention
+        return tuple(section for section in sections if self.parser.has_section(section))
+
+    def getCached(self, key, lookup):
+        value = self.lookupCache.get(key, self.lookupCache)
+        if value is self.lookupCache:
+            generation = self.cacheGeneration
+            value = lookup()
+            with self.cacheLock:
+                # Don't store anything read before a change
+                if generation == self.cacheGeneration:
+                    self.lookupCache[key] = value
+        return value
 
     def getPersonalPath(self, fileName):
         return os.path.join(os.path.expanduser("~/.capturemock"), fileName)
@@ -56,12 +85,21 @@ class RcFileHandler:
         return self._get(self.parser.getint, *args)
 
     def _get(self, getMethod, setting, sections, defaultVal=None):
+        sections = self.getKnownSections(sections)
+        value = self.getCached((getMethod.__name__, setting, sections), lambda: self._lookup(getMethod, setting, sections))
+        return defaultVal if value is None else value
+
+    def _lookup(self, getMethod, setting, sections):
         for section in sections:
             if self.parser.has_section(section) and self.parser.has_option(section, setting):
                 return getMethod(section, setting)
-        return defaultVal
 
     def getList(self, setting, sections):
+        # Copied, callers are free to change what they get
+        sections = self.getKnownSections(sections)
+        return list(self.getCached(("getList", setting, sections), lambda: self._getList(setting, sections)))
+
+    def _getList(self, setting, sections):
         result = []
         for section in sections:
             if self.parser.has_section(section) and self.parser.has_option(section, setting):
@@ -71,6 +109,9 @@ class RcFileHandler:
         return result
     
     def getSection(self, section):
+        return dict(self.getCached(("getSection", section), lambda: self._getSection(section)))
+
+    def _getSection(self, section):
         if self.parser.has_section(section):
             return dict(self.parser.items(section))
         else:
@@ -86,11 +127,38 @@ class RcFileHandler:
         if self.parser.has_section(section):
             # raises exceptions by default, but we can easily get the same mapping several times
             return False
-        self.parser.add_section(section)        
+        self.parser.add_section(section)
+        self.invalidateCaches()
         return True
 
     def set(self, *args):
-        return self.parser.set(*args)
+        self.parser.set(*args)
+        self.invalidateCaches()
+
+    def getAlterations(self, sections):
+        # Traffic objects are created all the time, don't compile the same alterations for each of them
+        # Keyed on what they're made from, so sections giving the same ones share them
+        definitions = []
+        for alterStr in self.getList("alterations", sections):
+            toFind = self.get("match_pattern", [ alterStr ])
+            if toFind:
+                definitions.append((alterStr, os.path.expandvars(toFind), self.getWithAddress("replacement", [ alterStr ])))
+        key = tuple(definitions)
+        alterations = self.alterationCache.get(key)
+        if alterations is None:
+            generation = self.cacheGeneration
+            alterations = AlterationDict()
+            for alterStr, toFind, toReplace in definitions:
+                if toFind and toReplace is not None:
+                    if alterStr == toFind and LiteralPattern.canUse(toFind, toReplace):
+                        # ID mappings are named after the ID they replace, there can be thousands of them
+                        alterations[LiteralPattern(toFind)] = toReplace
+                    else:
+                        alterations[re.compile(toFind)] = toReplace
+            with self.cacheLock:
+                if generation == self.cacheGeneration:
+                    self.alterationCache[key] = alterations
+        return alterations
 
     def setUpLogging(self, mainLogName):
         logConfigFile = self.get("log_config_file", [ "general" ],
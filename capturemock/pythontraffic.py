@@ -158,7 +158,7 @@ class PythonImportTraffic(PythonTraffic):
         text = "import " + self.moduleName
         super(PythonImportTraffic, self).__init__(text, *args)
 
-    def isMarkedForReplay(self, replayItems, responses):
+    def isMarkedForReplay(self, replayItems, responses, textMarkers):
         return self.getDescription() in responses
 
 
@@ -224,9 +224,10 @@ class PythonModuleTraffic(PythonTraffic):
         return type(obj) in cacheTypes or hasattr(obj, "__call__")
 
 
-    def isMarkedForReplay(self, replayItems, responses):
+    def isMarkedForReplay(self, replayItems, responses, textMarkers):
+        # Text markers are the recorded descriptions up to the first bracket, ours may contain brackets itself
         fullTextMarker = self.direction + self.typeId + ":" + self.getTextMarker()
-        return any((item == fullTextMarker or item.startswith(fullTextMarker + "(") for item in responses))
+        return fullTextMarker in textMarkers or fullTextMarker in responses
 
     def getIntercept(self, modOrAttr):
         if modOrAttr in self.interceptModules:
@@ -488,7 +489,7 @@ class PythonResponseTraffic(traffic.BaseTraffic):
 class PythonTrafficHandler:
     def __init__(self, replayInfo, recordFile, rcHandler, callStackChecker, interceptModules):
         self.replayInfo = replayInfo
-        self.recordFileHandler = RecordFileHandler(recordFile)
+        self.recordFileHandler = RecordFileHandler(recordFile, rcHandler)
         self.callStackChecker = callStackChecker
         self.rcHandler = rcHandler
         self.interceptModules = interceptModules
@@ -1,32 +1,132 @@
-
-""" Very basic interface for appending to a file. Server version much more complex """ 
-import os
+""" Very basic interface for appending to a file. Server version much more complex """
+import os, time, atexit, threading
+from capturemock import compressedfiles, recordformat
 
 class RecordFileHandler(object):
-    def __init__(self, file):
+    # When to write what we've recorded to disk. Anything unwritten is always written on close.
+    flushPolicies = [ "record", "request", "size", "interval", "shutdown" ]
+    def __init__(self, file, rcHandler=None):
         self.file = file
+        self.writeFile = None
+        self.registeredClose = False
         self.lastTruncationPoint = None
         self.recordedSinceTruncationPoint = []
+        self.flushPolicy = "record"
+        self.flushSize = 1024 * 1024
+        self.flushInterval = 1.0
+        if rcHandler:
+            self.flushPolicy = rcHandler.get("record_flush_policy", [ "general" ], self.flushPolicy)
+            self.flushSize = rcHandler.getint("record_flush_size", [ "general" ], self.flushSize)
+            self.flushInterval = rcHandler.getfloat("record_flush_interval", [ "general" ], self.flushInterval)
+            if self.flushPolicy not in self.flushPolicies:
+                raise RuntimeError("Unknown record_flush_policy " + repr(self.flushPolicy) + ", must be one of " + ", ".join(self.flushPolicies))
+        self.unflushedSize = 0
+        self.lastFlushTime = time.time()
+        self.flushTimer = None
+        # The flush timer writes from its own thread
+        self.writeLock = threading.RLock()
+        self.compression = compressedfiles.getWriteCompression(file, rcHandler) if file else None
+        self.format = recordformat.getWriteFormat(file, rcHandler) if file else "text"
+
+    def getWriteFile(self):
+        if self.writeFile is None:
+            self.writeFile = compressedfiles.openFile(self.file, "a", self.compression)
+            if not self.registeredClose:
+                # Make sure nothing is lost if we're never closed explicitly
+                atexit.register(self.close)
+                self.registeredClose = True
+        return self.writeFile
 
     def record(self, text, truncationPoint=False):
         if self.file:
-            if truncationPoint:
-                self.lastTruncationPoint = os.path.getsize(self.file)
-                self.recordedSinceTruncationPoint = []                
-            if self.lastTruncationPoint is not None:
-                self.recordedSinceTruncationPoint.append(text)
-            writeFile = open(self.file, "a")
-            writeFile.write(text)
-            writeFile.flush()
-            writeFile.close()
-            
-    def rerecord(self, oldText, newText):
-        if self.file:
-            writeFile = open(self.file, "a")
-            writeFile.truncate(self.lastTruncationPoint)
+            with self.writeLock:
+                writeFile = self.getWriteFile()
+                if truncationPoint:
+                    self.startTruncationPoint(writeFile)
+                if self.lastTruncationPoint is not None:
+                    self.recordedSinceTruncationPoint.append(text)
+                if self.lastTruncationPoint is None or not self.compression:
+                    self.write(writeFile, text)
+                self.unflushedSize += len(text)
+                self.flushIfNeeded()
+
+    def startTruncationPoint(self, writeFile):
+        if self.compression:
+            # Compressed streams can't be truncated, so hold back anything that might be rerecorded instead
+            self.writeHeldBack(writeFile)
+            self.lastTruncationPoint = 0
+        else:
+            self.lastTruncationPoint = writeFile.tell()
+        self.recordedSinceTruncationPoint = []
+
+    def writeHeldBack(self, writeFile):
+        if self.compression and self.lastTruncationPoint is not None:
             for text in self.recordedSinceTruncationPoint:
-                writeFile.write(text.replace(oldText, newText))
-            writeFile.flush()
-            writeFile.close()
+                self.write(writeFile, text)
             self.lastTruncationPoint = None
             self.recordedSinceTruncationPoint = []
+
+    def write(self, writeFile, text):
+        if self.format == "jsonl":
+            text = recordformat.textToJsonLines(text)
+        writeFile.write(text)
+
+    def flushIfNeeded(self):
+        if self.flushPolicy == "record" or \
+           (self.flushPolicy == "size" and self.unflushedSize >= self.flushSize):
+            self.flush()
+        elif self.flushPolicy == "interval":
+            timeLeft = self.lastFlushTime + self.flushInterval - time.time()
+            if timeLeft <= 0:
+                self.flush()
+            elif self.flushTimer is None:
+                # Otherwise it would wait for the next thing to be recorded, however long that takes
+                self.flushTimer = threading.Timer(timeLeft, self.flushFromTimer)
+                self.flushTimer.daemon = True
+                self.flushTimer.start()
+
+    def flushFromTimer(self):
+        with self.writeLock:
+            self.flushTimer = None
+            if self.unflushedSize:
+                self.flush()
+
+    def flushAtRequestEnd(self):
+        if self.flushPolicy == "request":
+            self.flush()
+
+    def flush(self):
+        with self.writeLock:
+            if self.writeFile is not None:
+                self.writeFile.flush()
+            self.unflushedSize = 0
+            self.lastFlushTime = time.time()
+
+    def close(self):
+        with self.writeLock:
+            if self.flushTimer is not None:
+                self.flushTimer.cancel()
+                self.flushTimer = None
+            if self.writeFile is not None:
+                self.writeHeldBack(self.writeFile)
+                self.writeFile.close()
+                self.writeFile = None
+            self.unflushedSize = 0
+            if self.registeredClose:
+                # Otherwise atexit keeps us alive until the interpreter exits
+                atexit.unregister(self.close)
+                self.registeredClose = False
+
+    def rerecord(self, oldText, newText):
+        if self.file:
+            with self.writeLock:
+                writeFile = self.getWriteFile()
+                if self.lastTruncationPoint is not None and not self.compression:
+                    writeFile.truncate(self.lastTruncationPoint)
+                    # Appending writes at the end anyway, but we need tell() to be right
+                    writeFile.seek(0, os.SEEK_END)
+                for text in self.recordedSinceTruncationPoint:
+                    self.write(writeFile, text.replace(oldText, newText))
+                self.flushIfNeeded()
+                self.lastTruncationPoint = None
+                self.recordedSinceTruncationPoint = []
@@ -0,0 +1,171 @@
+""" The JSON-lines record format, and conversion to and from the usual text format """
+import os, json
+from capturemock import compressedfiles
+
+formats = [ "text", "jsonl" ]
+headerStr = "\n--HEA:"
+timestampStr = "--TIM:"
+
+def isTrafficStart(line):
+    prefix = line.split(":")[0]
+    return len(prefix) < 10 and (prefix.startswith("<-") or prefix[-5:-3] == "->")
+
+def splitLines(text):
+    # Only newlines count, as when reading a file. str.splitlines knows about lots of other line breaks
+    lines = text.split("\n")
+    return [ line + "\n" for line in lines[:-1] ] + ([ lines[-1] ] if lines[-1] else [])
+
+def splitItems(lines):
+    # Each item is the text of one traffic, including its final newline
+    currItem = ""
+    for line in lines:
+        if isTrafficStart(line) and currItem:
+            yield currItem
+            currItem = ""
+        currItem += line
+    if currItem:
+        yield currItem
+
+def itemToRecord(item):
+    record = parseItem(item)
+    # Anything that doesn't come back exactly as it was is kept as it is
+    if record is None or recordToItem(record) != item:
+        return { "raw" : item }
+    return record
+
+def parseItem(item):
+    if not item.endswith("\n"):
+        return
+    body = item[:-1]
+    timestamp = None
+    lastLineStart = body.rfind("\n") + 1
+    if lastLineStart > 0 and body.startswith(timestampStr, lastLineStart):
+        timestamp = body[lastLineStart + len(timestampStr):]
+        body = body[:lastLineStart - 1]
+    parts = body.split(headerStr)
+    headers = []
+    for headerText in parts[1:]:
+        if "\n" in headerText or "=" not in headerText:
+            # Not really headers, just something that looks like them
+            headers = []
+            parts = [ body ]
+            break
+        headers.append(headerText.split("=", 1))
+    prefix, sep, text = parts[0].partition(":")
+    if not sep or len(prefix) < 3 or not isTrafficStart(prefix):
+        return
+    record = { "direction" : prefix[:-3], "type" : prefix[-3:], "text" : text }
+    if headers:
+        record["headers"] = headers
+    if timestamp is not None:
+        record["timestamp"] = timestamp
+    return record
+
+def recordToItem(record):
+    if "raw" in record:
+        return record["raw"]
+    item = record["direction"] + record["type"] + ":" + record["text"]
+    for header, value in record.get("headers", []):
+        item += headerStr + header + "=" + value
+    item += "\n"
+    if "timestamp" in record:
+        item += timestampStr + record["timestamp"] + "\n"
+    return item
+
+def textToJsonLines(text):
+    # Newlines as they would be after writing and reading back the text format
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return "".join(json.dumps(itemToRecord(item), ensure_ascii=False) + "\n" for item in splitItems(splitLines(text)))
+
+def getFormatFromExtension(fileName):
+    root, ext = os.path.splitext(fileName)
+    if compressedfiles.getCompressionFromExtension(fileName):
+        ext = os.path.splitext(root)[-1]
+    return "jsonl" if ext.lower() == ".jsonl" else None
+
+def getWriteFormat(fileName, rcHandler=None):
+    if os.path.isfile(fileName) and os.path.getsize(fileName) > 0:
+        # Appending, stick with whatever is there already
+        return "jsonl" if isJsonLines(fileName) else "text"
+    recordFormat = getFormatFromExtension(fileName)
+    if recordFormat is None and rcHandler:
+        recordFormat = rcHandler.get("record_format", [ "general" ])
+        if recordFormat and recordFormat not in formats:
+            raise RuntimeError("Unknown record_format " + repr(recordFormat) + ", must be one of " + ", ".join(formats))
+    return recordFormat or "text"
+
+def isJsonLines(fileName):
+    with compressedfiles.openFile(fileName) as f:
+        line = f.readline()
+    if line.startswith("{"):
+        try:
+            return isinstance(json.loads(line), dict)
+        except ValueError:
+            pass
+    return False
+
+
+class TextView:
+    """ Reads a JSON-lines file as if it were in the text format """
+    def __init__(self, readFile):
+        self.readFile = readFile
+        self.lines = None
+        self.buffer = ""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.readFile.close()
+
+    def __iter__(self):
+        for line in self.readFile:
+            if line.strip():
+                yield from splitLines(recordToItem(json.loads(line)))
+
+    def read(self, size=-1):
+        if self.lines is None:
+            self.lines = iter(self)
+        if size < 0:
+            text = self.buffer + "".join(self.lines)
+            self.buffer = ""
+            return text
+        chunks = [ self.buffer ]
+        bufferSize = len(self.buffer)
+        while bufferSize < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            chunks.append(line)
+            bufferSize += len(line)
+        text = "".join(chunks)
+        self.buffer = text[size:]
+        return text[:size]
+
+
+def openFile(fileName, **kwargs):
+    # For reading files in either format, with or without compression
+    readFile = compressedfiles.openFile(fileName, **kwargs)
+    if isJsonLines(fileName):
+        return TextView(readFile)
+    return readFile
+
+def readItems(fileName):
+    if isJsonLines(fileName):
+        with compressedfiles.openFile(fileName) as f:
+            return [ recordToItem(json.loads(line)) for line in f if line.strip() ]
+    with compressedfiles.openFile(fileName, newline=None) as f:
+        return list(splitItems(f))
+
+def convert(inFile, outFile, outFormat=None, compression=None):
+    outFormat = outFormat or getFormatFromExtension(outFile) or "text"
+    items = readItems(inFile) # before opening the output, which may be the same file
+    with compressedfiles.openFile(outFile, "w", compression) as f:
+        for item in items:
+            if outFormat == "jsonl":
+                f.write(json.dumps(itemToRecord(item), ensure_ascii=False) + "\n")
+            else:
+                f.write(item)
@@ -1,6 +1,7 @@
 """ Module to manage the information in the file and return appropriate matches """
 
-import logging, difflib, re
+import logging, difflib, re, os, sys, time, threading, pickle, hashlib, mmap, locale, bisect
+from collections import Counter
 from pprint import pformat
 
 try: # Python 2.7, Python 3.x
@@ -9,34 +10,109 @@ except ImportError: # Python 2.6 and earlier
     from ordereddict import OrderedDict
 
 from capturemock.traffic import BaseTraffic
-from capturemock import config, id_mapping
+from capturemock import config, id_mapping, compressedfiles, recordformat
 
 class ReplayInfo:
+    # Bump if the parsed structures change, so that old cache files are ignored
+    cacheFormat = 6
+    # Separators are / ( ) \ and whitespace
+    wordRegex = re.compile(r"[^/()\\\s]+")
+    cachedAttributes = [ "responseMap", "keyPositions", "wordIndex", "textMarkers", "replayItems" ]
     def __init__(self, mode, replayFile, rcHandler):
         self.responseMap = OrderedDict()
+        self.keyPositions = {}
+        self.wordIndex = {}
+        self.textMarkers = set()
+        self.callHandlers = []
+        self.callPositions = []
+        self.prefixIndex = None
+        self.bestMatchCache = OrderedDict() # least recently used first
+        self.bestMatchDependents = {}
+        self.bestMatchTies = {}
         self.diag = logging.getLogger("Replay")
         self.replayItems = set()
         self.replayAll = mode == config.REPLAY
         self.exactMatching = rcHandler.getboolean("use_exact_matching", [ "general" ], False)
+        self.fuzzyMatchMaxTokens = rcHandler.getint("fuzzy_match_max_tokens", [ "general" ])
+        self.fuzzyMatchTimeBudget = rcHandler.getfloat("fuzzy_match_time_budget", [ "general" ])
+        self.bestMatchCacheSize = rcHandler.getint("fuzzy_match_cache_size", [ "general" ], 1000)
         self.idFinder = None
         self.idMap = {}
         self.prevResponseMapKeys = set()
+        # Servers may replay from several threads at once. Handlers lock themselves, these are for the rest
+        self.idMapLock = threading.Lock()
+        self.prevKeysLock = threading.Lock()
+        self.bestMatchLock = threading.Lock()
+        self.bestMatchGeneration = 0
         if replayFile:
             self.idFinder = id_mapping.IdFinder(rcHandler, "id_pattern_client")
-            trafficList = self.readIntoList(replayFile)
-            self.parseTrafficList(trafficList)
-            items = self.makeCommandItems(rcHandler.getIntercepts("command line")) + \
-                    self.makePythonItems(rcHandler.getIntercepts("python"))
-            self.replayItems = self.filterForReplay(items, trafficList)
+            commands = rcHandler.getIntercepts("command line")
+            pythonAttrs = rcHandler.getIntercepts("python")
+            self.lazyResponses = rcHandler.getboolean("lazy_replay_responses", [ "general" ], False)
+            useCache = rcHandler.getboolean("use_replay_cache", [ "general" ], False)
+            cacheKey = self.getCacheKey(replayFile, commands, pythonAttrs) if useCache else None
+            if not useCache or not self.readCache(replayFile, cacheKey):
+                scanner = ReplayItemScanner(commands, pythonAttrs)
+                # Only plain text files can be memory-mapped, anything else is always read up front
+                if self.lazyResponses and not compressedfiles.isCompressed(replayFile) and not recordformat.isJsonLines(replayFile):
+                    trafficList = self.readIntoLazyList(replayFile)
+                    # Intercepts can only match what the SUT sent, which is never left in the file
+                    requests = [ trafficStr for trafficStr in trafficList if isinstance(trafficStr, str) ]
+                    self.replayItems = scanner.findItems(requests)
+                else:
+                    trafficList = self.readIntoList(replayFile)
+                    self.replayItems = scanner.findItems(trafficList)
+                self.parseTrafficList(trafficList)
+                if useCache:
+                    self.writeCache(replayFile, cacheKey)
 
     @staticmethod
-    def filterForReplay(itemInfo, lines):
-        newItems = set()
-        for line in lines:
-            for item, regexp in itemInfo:
-                if regexp.search(line):
-                    newItems.add(item)
-        return newItems
+    def getCacheFile(replayFile):
+        return replayFile + ".cmcache"
+
+    def getCacheKey(self, replayFile, commands, pythonAttrs):
+        # Anything that affects the parsed result must be part of the key
+        sha = hashlib.sha256()
+        with open(replayFile, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(block)
+        settings = self.cacheFormat, self.lazyResponses, BaseTraffic.preserveCr, BaseTraffic.preserveLf, sorted(commands), sorted(pythonAttrs)
+        sha.update(repr(settings).encode())
+        return sha.hexdigest()
+
+    def readCache(self, replayFile, cacheKey):
+        cacheFile = self.getCacheFile(replayFile)
+        if not os.path.isfile(cacheFile):
+            return False
+        try:
+            with open(cacheFile, "rb") as f:
+                storedKey, data = pickle.load(f)
+        except Exception as e:
+            self.diag.debug("Failed to read replay cache at " + cacheFile + ": " + str(e))
+            return False
+
+        if storedKey != cacheKey:
+            self.diag.debug("Replay cache at " + cacheFile + " is out of date, ignoring it")
+            return False
+
+        for attrName in self.cachedAttributes:
+            setattr(self, attrName, data[attrName])
+        self.diag.debug("Read replay info from cache at " + cacheFile)
+        return True
+
+    def writeCache(self, replayFile, cacheKey):
+        cacheFile = self.getCacheFile(replayFile)
+        data = dict((attrName, getattr(self, attrName)) for attrName in self.cachedAttributes)
+        # Write to a temporary file and move it, other processes may be reading the same cache
+        tmpFile = cacheFile + "." + str(os.getpid())
+        try:
+            with open(tmpFile, "wb") as f:
+                pickle.dump((cacheKey, data), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpFile, cacheFile)
+        except (OSError, pickle.PicklingError) as e:
+            self.diag.debug("Failed to write replay cache at " + cacheFile + ": " + str(e))
+            if os.path.isfile(tmpFile):
+                os.remove(tmpFile)
 
     @staticmethod
     def makeCommandItems(commands):
@@ -55,7 +131,7 @@ class ReplayInfo:
         elif self.replayAll:
             return True
         else:
-            return traffic.isMarkedForReplay(self.replayItems, list(self.responseMap.keys()))
+            return traffic.isMarkedForReplay(self.replayItems, self.responseMap, self.textMarkers)
 
     def getTrafficLookupKey(self, trafficStr):
         # If we're matching server communications it means we're 'playing client'
@@ -75,7 +151,7 @@ class ReplayInfo:
     def parseTrafficList(self, trafficList):
         currResponseHandlers = []
         for trafficStr in trafficList:
-            prefix = trafficStr.split(":")[0]
+            prefix = getTrafficPrefix(trafficStr)
             indentLevel = int(len(prefix) / 2) - 2
             fromSUT = prefix.startswith("<-")
             while self.responseCompleted(currResponseHandlers, indentLevel, fromSUT):
@@ -85,45 +161,64 @@ class ReplayInfo:
                 responseHandler, _ = currResponseHandlers[-1]
                 responseHandler.addResponse(trafficStr)
             if fromSUT or indentLevel > len(currResponseHandlers) - 1:
-                currTrafficIn = self.getTrafficLookupKey(trafficStr.strip())
+                currTrafficIn = self.getTrafficLookupKey(str(trafficStr).strip())
                 responseHandler = self.responseMap.get(currTrafficIn)
                 if responseHandler:
                     responseHandler.newResponse()
-                    if prefix.endswith("PYT") and not "(" in trafficStr:
-                        self.registerIntermediateCalls(responseHandler)
+                    if prefix.endswith("PYT") and not "(" in currTrafficIn:
+                        self.registerIntermediateCalls(currTrafficIn, responseHandler)
                 else:
                     responseHandler = ReplayedResponseHandler()
-                    self.responseMap[currTrafficIn] = responseHandler
+                    self.addResponseHandler(currTrafficIn, responseHandler)
                 if indentLevel > len(currResponseHandlers) - 1:
                     currResponseHandlers.append((responseHandler, fromSUT))
                 else:
                     currResponseHandlers[-1] = responseHandler, fromSUT
-        self.diag.debug("Replay info " + pformat(self.responseMap))
-
-    def registerIntermediateCalls(self, currResponseHandler):
-        intermediate = []
-        for trafficIn in reversed(self.responseMap):
-            responseHandler = self.responseMap[trafficIn]
-            if responseHandler is currResponseHandler:
-                break
-            if "(" in trafficIn:
-                intermediate.insert(0, responseHandler)
+        if self.diag.isEnabledFor(logging.DEBUG):
+            self.diag.debug("Replay info " + pformat(self.responseMap))
+
+    def addResponseHandler(self, trafficIn, responseHandler):
+        self.keyPositions[trafficIn] = len(self.responseMap)
+        self.responseMap[trafficIn] = responseHandler
+        self.textMarkers.add(trafficIn.split("(", 1)[0])
+        if "(" in trafficIn:
+            self.callPositions.append(self.keyPositions[trafficIn])
+            self.callHandlers.append(responseHandler)
+        trafficType = self.getTrafficType(trafficIn)
+        typeWordIndex = self.wordIndex.setdefault(trafficType, {})
+        for word, count in Counter(self.getWords(trafficIn)).items():
+            typeWordIndex.setdefault(word, []).append((trafficIn, count))
+
+    def registerIntermediateCalls(self, currTrafficIn, currResponseHandler):
+        # All calls first seen since this traffic was first seen
+        # Share the list of calls rather than copying it, it is only ever added to
+        start = bisect.bisect_right(self.callPositions, self.keyPositions[currTrafficIn])
+        intermediate = HandlerRange(self.callHandlers, start, len(self.callHandlers))
         currResponseHandler.addIntermediate(intermediate)
 
     @classmethod
     def readIntoList(cls, replayFile):
+        return [ BaseTraffic.fixNewlinesFromReplay(item) for item in recordformat.readItems(replayFile) ]
+
+    @classmethod
+    def readIntoLazyList(cls, replayFile):
+        # As readIntoList, but responses are left in the memory-mapped file until they are needed
         trafficList = []
-        currTraffic = ""
-        with open(replayFile, newline=None) as f:
-            for line in f:
-                prefix = line.split(":")[0]
-                if len(prefix) < 10 and (prefix.startswith("<-") or prefix[-5:-3] == "->"):
-                    if currTraffic:
-                        trafficList.append(BaseTraffic.fixNewlinesFromReplay(currTraffic))
-                    currTraffic = ""
-                currTraffic += line
-        if currTraffic:
-            trafficList.append(BaseTraffic.fixNewlinesFromReplay(currTraffic))
+        mappedFile = MappedReplayFile(replayFile)
+        data = mappedFile.getData()
+        currStart, currPrefix = 0, None
+        pos = 0
+        while pos < len(data):
+            end = data.find(b"\n", pos)
+            end = len(data) if end == -1 else end + 1
+            prefix = mappedFile.readPrefix(pos, end)
+            if prefix is not None and len(prefix) < 10 and (prefix.startswith("<-") or prefix[-5:-3] == "->"):
+                if pos > currStart:
+                    trafficList.append(mappedFile.makeTraffic(currStart, pos, currPrefix))
+                currStart, currPrefix = pos, prefix
+            pos = end
+        if len(data) > currStart:
+            trafficList.append(mappedFile.makeTraffic(currStart, len(data), currPrefix))
         return trafficList
 
     def readReplayResponses(self, traffic, allClasses, exact=False):
@@ -135,11 +230,19 @@ class ReplayInfo:
         responseMapKey = self.getResponseMapKey(traffic, exact)
         if responseMapKey:
             replayId, recordId = self.makeIdMapping(traffic, responseMapKey)
-            if traffic.canModifyServer():
-                self.prevResponseMapKeys.clear()
-            duplicate = not traffic.hasRepeatsInReplay() and responseMapKey in self.prevResponseMapKeys
-            self.prevResponseMapKeys.add(responseMapKey)
-            return self.responseMap[responseMapKey].makeResponses(allClasses, replayId, recordId, duplicate)
+            if replayId and recordId:
+                traffic.replayIdMapping = replayId, recordId
+            with self.prevKeysLock:
+                if traffic.canModifyServer():
+                    self.prevResponseMapKeys.clear()
+                duplicate = not traffic.hasRepeatsInReplay() and responseMapKey in self.prevResponseMapKeys
+                self.prevResponseMapKeys.add(responseMapKey)
+            responseHandler = self.responseMap[responseMapKey]
+            timesChosen = responseHandler.timesChosen
+            responses = responseHandler.makeResponses(allClasses, replayId, recordId, duplicate)
+            if responseHandler.timesChosen != timesChosen:
+                self.invalidateBestMatches(responseMapKey)
+            return responses
         else:
             return []
         
@@ -150,20 +253,32 @@ class ReplayInfo:
             if recordId:
                 replayTrafficText = replayTrafficDesc.split(":", 1)[-1]
                 replayId = self.idFinder.extractIdFromText(replayTrafficText)
-                if replayId not in self.idMap:
-                    new_map = { replayId: recordId }
-                    id_mapping.make_id_alterations_rc_file(new_map)
-                    self.idMap.update(new_map)
+                with self.idMapLock:
+                    if replayId not in self.idMap:
+                        new_map = { replayId: recordId }
+                        id_mapping.make_id_alterations_rc_file(new_map)
+                        self.idMap.update(new_map)
         
         return replayId, recordId
 
     def findResponseToTrafficStartingWith(self, prefix):
-        for currDesc, responseHandler in self.responseMap.items():
-            _, text = currDesc.split(":", 1)
-            if text.startswith(prefix):
-                response = responseHandler.getFirstResponse()
-                if response:
-                    return response[6:]
+        texts, keys = self.getPrefixIndex()
+        start = bisect.bisect_left(texts, prefix)
+        end = start
+        while end < len(texts) and texts[end].startswith(prefix):
+            end += 1
+        # Go through them in file order, the first one with a response wins
+        for currDesc in sorted(keys[start:end], key=self.keyPositions.get):
+            response = self.responseMap[currDesc].getFirstResponse()
+            if response:
+                return str(response)[6:]
+
+    def getPrefixIndex(self):
+        # Only built when needed, it's only used when replaying Python
+        if self.prefixIndex is None:
+            items = sorted((currDesc.split(":", 1)[-1], currDesc) for currDesc in self.responseMap)
+            self.prefixIndex = [ text for text, _ in items ], [ currDesc for _, currDesc in items ]
+        return self.prefixIndex
 
     def getResponseMapKey(self, traffic, exact):
         desc = self.getTrafficLookupKey(traffic.getDescription())
@@ -178,42 +293,175 @@ class ReplayInfo:
                 return self.findBestMatch(desc)
 
     def findBestMatch(self, desc):
+        with self.bestMatchLock:
+            if desc in self.bestMatchCache:
+                self.bestMatchCache.move_to_end(desc)
+                bestMatch = self.bestMatchCache[desc]
+                self.diag.debug("Using previously chosen best match " + repr(bestMatch))
+                return bestMatch
+            generation = self.bestMatchGeneration
+
+        # Don't hold the lock while matching, it can take a while
+        bestMatch, tied = self.calculateBestMatch(desc)
+        with self.bestMatchLock:
+            # If anything was invalidated meanwhile, our result may already be out of date
+            if generation == self.bestMatchGeneration and self.bestMatchCacheSize > 0:
+                self.bestMatchCache[desc] = bestMatch
+                if len(tied) > 1:
+                    # The choice between these depends on how many responses each has left
+                    self.bestMatchTies[desc] = tied
+                    for currDesc in tied:
+                        self.bestMatchDependents.setdefault(currDesc, set()).add(desc)
+                # Requests that never repeat, e.g. with a timestamp in, would otherwise fill it up forever
+                while len(self.bestMatchCache) > self.bestMatchCacheSize:
+                    oldDesc, _ = self.bestMatchCache.popitem(last=False)
+                    self.forgetTies(oldDesc)
+        return bestMatch
+
+    def invalidateBestMatches(self, responseMapKey):
+        with self.bestMatchLock:
+            self.bestMatchGeneration += 1
+            for desc in self.bestMatchDependents.pop(responseMapKey, []):
+                self.bestMatchCache.pop(desc, None)
+                self.forgetTies(desc)
+
+    def forgetTies(self, desc):
+        for currDesc in self.bestMatchTies.pop(desc, []):
+            dependents = self.bestMatchDependents.get(currDesc)
+            if dependents is not None:
+                dependents.discard(desc)
+                if not dependents:
+                    del self.bestMatchDependents[currDesc]
+
+    def calculateBestMatch(self, desc):
+        # Only entries of the same type are ever considered
+        trafficType = self.getTrafficType(desc)
+        if trafficType not in self.wordIndex:
+            return None, []
+
+        startTime = time.perf_counter()
         descWords = self.getWords(desc)
-        bestMatch = None
-        bestMatchInfo = set(), 100000
-        for currDesc, responseHandler in self.responseMap.items():
-            if self.sameType(desc, currDesc):
-                descToCompare = currDesc
-                self.diag.debug("Comparing with '" + descToCompare + "'")
-                matchInfo = self.getWords(descToCompare), responseHandler.getUnmatchedResponseCount()
-                if self.isBetterMatch(matchInfo, bestMatchInfo, descWords):
-                    bestMatchInfo = matchInfo
-                    bestMatch = currDesc
-
-        if bestMatch is not None:
+        scorer = self.makeScorer(descWords)
+        # Only entries sharing a word with the request can have anything in common with it
+        candidates = self.findCandidates(self.wordIndex[trafficType], descWords)
+        bestMatch, bestScore, tied, comparedCount = self.findBestMatchAmong(candidates, scorer)
+        self.checkTimeBudget(desc, scorer, comparedCount, time.perf_counter() - startTime)
+        # Nothing else can do better than having nothing in common, so there's no point looking further
+        if bestMatch is not None and bestScore[0] > 0:
             self.diag.debug("Best match chosen as '" + bestMatch + "'")
-            return bestMatch
+            return bestMatch, tied
+        else:
+            # Unmatched counts only ever go down, so nothing can become a match later
+            return None, []
 
-    def sameType(self, desc1, desc2):
-        return desc1[2:5] == desc2[2:5]
+    def makeScorer(self, descWords):
+        if self.fuzzyMatchMaxTokens is not None:
+            return LengthLimitedScorer(descWords, self.fuzzyMatchMaxTokens)
+        else:
+            return SequenceMatchScorer(descWords)
+
+    def checkTimeBudget(self, desc, scorer, candidateCount, timeTaken):
+        if self.fuzzyMatchTimeBudget is not None and timeTaken > self.fuzzyMatchTimeBudget:
+            message = "WARNING: Finding the best replay match took " + str(round(timeTaken, 3)) + \
+                      " seconds, exceeding the fuzzy_match_time_budget of " + str(self.fuzzyMatchTimeBudget) + ".\n" + \
+                      "Compared " + str(candidateCount) + " recorded requests with " + scorer.getName() + \
+                      " for the request beginning '" + desc[:60] + "'\n"
+            self.diag.info(message)
+            sys.stderr.write(message)
+
+    def findCandidates(self, typeWordIndex, descWords):
+        # No scorer can find more words in common than the two share, counting repeats
+        bounds = {}
+        for word, descCount in Counter(descWords).items():
+            for currDesc, count in typeWordIndex.get(word, []):
+                bounds[currDesc] = bounds.get(currDesc, 0) + min(count, descCount)
+        # Most promising first, so we can stop early. Otherwise file order
+        return sorted(bounds.items(), key=lambda item: (-item[1], self.keyPositions[item[0]]))
+
+    def findBestMatchAmong(self, candidates, scorer):
+        # A match has to do better than having nothing in common
+        bestMatch = None
+        bestMatchInfo = (0, 0), 100000
+        scores = []
+        for currDesc, bound in candidates:
+            if bound < bestMatchInfo[0][0]:
+                # Neither this nor anything after it can do better, or even tie
+                break
+            self.diag.debug("Comparing with '" + currDesc + "'")
+            score = scorer.getScore(self.getWords(currDesc))
+            scores.append((currDesc, score))
+            matchInfo = score, self.responseMap[currDesc].getUnmatchedResponseCount()
+            # Earlier entries in the file win ties
+            if self.isBetterMatch(matchInfo, bestMatchInfo) or \
+               (matchInfo == bestMatchInfo and self.keyPositions[currDesc] < self.keyPositions[bestMatch]):
+                bestMatchInfo = matchInfo
+                bestMatch = currDesc
+        bestScore = bestMatchInfo[0]
+        tied = [ currDesc for currDesc, score in scores if score == bestScore ]
+        return bestMatch, bestScore, tied, len(scores)
+
+    def getTrafficType(self, desc):
+        return desc[2:5]
 
     def getWords(self, desc):
         # Heuristic decisions trying to make the best of inexact matches
-        separators = [ "/", "(", ")", "\\", None ] # the last means whitespace...
-        return self._getWords(desc, separators)
+        return self.wordRegex.findall(desc)
+
+    def isBetterMatch(self, info1, info2):
+        (common1, nonMatchCount1), unmatchedCount1 = info1
+        (common2, nonMatchCount2), unmatchedCount2 = info2
+        self.diag.debug("Words in common " + repr(common1) + " vs " + repr(common2))
+        if common1 > common2:
+            return True
+        elif common1 < common2:
+            return False
+
+        self.diag.debug("Non matching sequences " + repr(nonMatchCount1) + " vs " + repr(nonMatchCount2))
+        if nonMatchCount1 < nonMatchCount2:
+            return True
+        elif nonMatchCount1 > nonMatchCount2:
+            return False
+
+        self.diag.debug("Unmatched count difference " + repr(unmatchedCount1) + " vs " + repr(unmatchedCount2))
+        return unmatchedCount1 > unmatchedCount2
+
+
+class LengthLimitedScorer:
+    """ Scores exactly unless the request or the recorded one has too many words, when it approximates """
+    def __init__(self, targetWords, maxTokens):
+        self.targetWords = targetWords
+        self.maxTokens = maxTokens
+        self.scorers = {} # made when first needed, each analyses the target once
+
+    def getScore(self, words):
+        scorerClass = ShingleMatchScorer if max(len(words), len(self.targetWords)) > self.maxTokens else SequenceMatchScorer
+        scorer = self.scorers.get(scorerClass)
+        if scorer is None:
+            scorer = self.scorers[scorerClass] = scorerClass(self.targetWords)
+        return scorer.getScore(words)
+
+    def getName(self):
+        return " and ".join((scorer.getName() for scorer in self.scorers.values())) or self.__class__.__name__
+
 
-    def _getWords(self, desc, separators):
-        if len(separators) == 0:
-            return [ desc ]
+class SequenceMatchScorer:
+    """ Scores by the words in common and how many separate sequences they are in.
+    The most exact measure, but quadratic in the number of words in the worst case """
+    def __init__(self, targetWords):
+        # Analysis of the target is kept between comparisons
+        self.matcher = difflib.SequenceMatcher(None)
+        self.matcher.set_seq2(targetWords)
 
-        words = []
-        for part in desc.split(separators[0]):
-            words += self._getWords(part, separators[1:])
-        return words
+    def getScore(self, words):
+        blocks = self.getMatchingBlocks(words)
+        return self.commonElementCount(blocks), self.nonMatchingSequenceCount(blocks)
 
-    def getMatchingBlocks(self, list1, list2):
-        matcher = difflib.SequenceMatcher(None, list1, list2)
-        return list(matcher.get_matching_blocks())
+    def getName(self):
+        return self.__class__.__name__
+
+    def getMatchingBlocks(self, words):
+        self.matcher.set_seq1(words)
+        return list(self.matcher.get_matching_blocks())
 
     def commonElementCount(self, blocks):
         return sum((block.size for block in blocks))
@@ -228,29 +476,27 @@ class ReplayInfo:
         return blocks[-2].a + blocks[-2].size == blocks[-1].a and \
                blocks[-2].b + blocks[-2].size == blocks[-1].b
 
-    def isBetterMatch(self, info1, info2, targetWords):
-        words1, unmatchedCount1 = info1
-        words2, unmatchedCount2 = info2
-        blocks1 = self.getMatchingBlocks(words1, targetWords)
-        blocks2 = self.getMatchingBlocks(words2, targetWords)
-        common1 = self.commonElementCount(blocks1)
-        common2 = self.commonElementCount(blocks2)
-        self.diag.debug("Words in common " + repr(common1) + " vs " + repr(common2))
-        if common1 > common2:
-            return True
-        elif common1 < common2:
-            return False
 
-        nonMatchCount1 = self.nonMatchingSequenceCount(blocks1)
-        nonMatchCount2 = self.nonMatchingSequenceCount(blocks2)
-        self.diag.debug("Non matching sequences " + repr(nonMatchCount1) + " vs " + repr(nonMatchCount2))
-        if nonMatchCount1 < nonMatchCount2:
-            return True
-        elif nonMatchCount1 > nonMatchCount2:
-            return False
+class ShingleMatchScorer:
+    """ Scores by the runs of consecutive words in common, regardless of where they are.
+    Approximate, but linear in the number of words """
+    shingleSize = 3
+    def __init__(self, targetWords):
+        self.targetShingles = Counter(self.makeShingles(targetWords))
 
-        self.diag.debug("Unmatched count difference " + repr(unmatchedCount1) + " vs " + repr(unmatchedCount2))
-        return unmatchedCount1 > unmatchedCount2
+    def makeShingles(self, words):
+        if len(words) <= self.shingleSize:
+            return [ tuple(words) ]
+        return zip(*(words[i:] for i in range(self.shingleSize)))
+
+    def getScore(self, words):
+        shingles = Counter(self.makeShingles(words))
+        common = sum((shingles & self.targetShingles).values())
+        different = sum((shingles | self.targetShingles).values()) - common
+        return common, different
+
+    def getName(self):
+        return self.__class__.__name__
 
 
 # Need to handle multiple replies to the same question
@@ -259,6 +505,16 @@ class ReplayedResponseHandler:
         self.timesChosen = 0
         self.responses = [[]]
         self.intermediateHandlers = []
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"] # can't be pickled
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
 
     def __repr__(self):
         return repr(self.responses)
@@ -299,28 +555,175 @@ class ReplayedResponseHandler:
         return len(self.responses) - self.timesChosen
 
     def makeResponses(self, allClasses, replayId, recordId, duplicate):
-        responseIndex = self.timesChosen - 1 if (duplicate and self.timesChosen > 0) else self.timesChosen
-        trafficStrings, increment = self.getCurrentStrings(responseIndex)
+        # Choosing the response and moving on to the next one must be atomic, the rest needn't be
+        with self.lock:
+            responseIndex = self.timesChosen - 1 if (duplicate and self.timesChosen > 0) else self.timesChosen
+            trafficStrings, increment = self.getCurrentStrings(responseIndex)
+            if not duplicate:
+                self.timesChosen += increment
         responses = []
         for trafficStr in trafficStrings:
-            prefix, text = trafficStr.split(":", 1)
+            prefix, text = str(trafficStr).split(":", 1)
             trafficType = prefix[-3:]
             for trafficClass in allClasses:
                 if trafficClass.typeId == trafficType:
                     if replayId and recordId:
                         text = text.replace(replayId, recordId)
                     responses.append((trafficClass, text))
-        if not duplicate:
-            self.timesChosen += increment
         return responses
     
 
-def filterFileForReplay(itemInfo, replayFile):
-    with open(replayFile, newline=None) as f:
-        return ReplayInfo.filterForReplay(itemInfo, f)
+class HandlerRange:
+    """ A fixed part of a list of handlers that may grow later """
+    def __init__(self, handlers, start, end):
+        self.handlers = handlers
+        self.start = start
+        self.end = end
+
+    def __iter__(self):
+        return (self.handlers[i] for i in range(self.start, self.end))
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def getTrafficPrefix(trafficStr):
+    if isinstance(trafficStr, ReplayFileSegment):
+        return trafficStr.prefix
+    else:
+        return trafficStr.split(":")[0]
+
+
+class MappedReplayFile:
+    encoding = locale.getpreferredencoding(False) # what open() would use
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.data = None
+
+    def __getstate__(self):
+        # Can't pickle the mapping itself, it is recreated when first needed
+        return { "fileName" : self.fileName }
+
+    def __setstate__(self, state):
+        self.fileName = state["fileName"]
+        self.data = None
+
+    def getData(self):
+        if self.data is None:
+            with open(self.fileName, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return b"" # can't map empty files
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.data
+
+    def readPrefix(self, start, end):
+        colonPos = self.data.find(b":", start, end)
+        prefixEnd = end if colonPos == -1 else colonPos
+        # Anything longer than this can't be a traffic prefix, whatever it decodes to
+        if prefixEnd - start < 40:
+            return self.decode(start, prefixEnd)
+
+    def decode(self, start, end):
+        text = self.getData()[start:end].decode(self.encoding)
+        # Universal newlines, as when reading the file in text mode
+        return text.replace("\r\n", "\n").replace("\r", "\n")
+
+    def makeTraffic(self, start, end, prefix):
+        if prefix is None or prefix.startswith("<-"):
+            return BaseTraffic.fixNewlinesFromReplay(self.decode(start, end))
+        else:
+            return ReplayFileSegment(self, start, end, prefix)
+
+
+class ReplayFileSegment:
+    """ Traffic text which is only read from the replay file when it is replayed """
+    def __init__(self, mappedFile, start, end, prefix):
+        self.mappedFile = mappedFile
+        self.start = start
+        self.end = end
+        self.prefix = prefix
+
+    def __str__(self):
+        return BaseTraffic.fixNewlinesFromReplay(self.mappedFile.decode(self.start, self.end))
+
+    def __repr__(self):
+        return "<" + self.prefix + " at " + str(self.start) + "-" + str(self.end) + ">"
+
+
+class PrefixMatcher:
+    def __init__(self, items):
+        self.items = set(items)
+        self.lengths = sorted(set((len(item) for item in self.items)))
+
+    def __bool__(self):
+        return len(self.items) > 0
+
+    def findItemsAt(self, text, pos, found):
+        for length in self.lengths:
+            candidate = text[pos:pos + length]
+            if len(candidate) < length:
+                break
+            if candidate in self.items:
+                found.add(candidate)
+
+
+class ReplayItemScanner:
+    """ Finds which intercepted commands and Python attributes are used in replay text,
+    with a single scan however many of them there are """
+    markerRegex = re.compile("<-(CMD|PYT):")
+    def __init__(self, commands, pythonAttrs):
+        # Intercepts are generally plain names, which we can look up in sets at the places they might appear
+        # Dots are taken literally, as they are in the recorded text
+        plainCommands = list(filter(self.isPlain, commands))
+        plainAttrs = list(filter(self.isPlain, pythonAttrs))
+        self.commandMatcher = PrefixMatcher(plainCommands)
+        self.pythonMatcher = PrefixMatcher(plainAttrs)
+        # Anything else is searched for with its own regular expression as before
+        self.regexItems = ReplayInfo.makeCommandItems([ cmd for cmd in commands if cmd not in plainCommands ]) + \
+                          ReplayInfo.makePythonItems([ attr for attr in pythonAttrs if attr not in plainAttrs ])
+
+    @staticmethod
+    def isPlain(item):
+        return re.escape(item.replace(".", "")) == item.replace(".", "")
+
+    def findItems(self, texts):
+        found = set()
+        for text in texts:
+            self.findItemsIn(text, found)
+        return found
+
+    def findItemsIn(self, text, found):
+        scannedTo = 0
+        for match in self.markerRegex.finditer(text):
+            start = match.end()
+            if match.group(1) == "CMD":
+                if self.commandMatcher:
+                    # The command may be any word of the recorded command line
+                    self.commandMatcher.findItemsAt(text, start, found)
+                    spacePos = text.find(" ", max(start, scannedTo))
+                    while spacePos != -1:
+                        self.commandMatcher.findItemsAt(text, spacePos + 1, found)
+                        spacePos = text.find(" ", spacePos + 1)
+                    scannedTo = len(text)
+            elif self.pythonMatcher:
+                self.pythonMatcher.findItemsAt(text, start, found)
+                if text.startswith("import ", start):
+                    self.pythonMatcher.findItemsAt(text, start + len("import "), found)
+
+        for item, regexp in self.regexItems:
+            if item not in found and regexp.search(text):
+                found.add(item)
+
+
+def filterFileForReplay(scanner, replayFile):
+    with recordformat.openFile(replayFile, newline=None) as f:
+        return scanner.findItems(f)
 
 def filterCommands(commands, replayFile):
-    return filterFileForReplay(ReplayInfo.makeCommandItems(commands), replayFile)
+    return filterFileForReplay(ReplayItemScanner(commands, []), replayFile)
 
 def filterPython(pythonAttrs, replayFile):
-    return filterFileForReplay(ReplayInfo.makePythonItems(pythonAttrs), replayFile)
+    return filterFileForReplay(ReplayItemScanner([], pythonAttrs), replayFile)
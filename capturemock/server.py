@@ -1,4 +1,4 @@
-import os, stat, sys, socket, threading, time, subprocess
+import os, stat, sys, socket, threading, time, subprocess, logging, queue
 from copy import copy
 
 from capturemock import config, id_mapping
@@ -110,10 +110,69 @@ def stopServer(servAddr, protocol):
                   ", seemed not to be running anyway.", file=sys.stderr)
 
 
+class RequestWorkerPool:
+    """ A fixed number of threads to handle requests, which wait in a bounded queue until one is free """
+    def __init__(self, workerCount, queueSize):
+        self.requestQueue = queue.Queue(queueSize)
+        self.metricsLock = threading.Lock()
+        self.requestsHandled = 0
+        self.queueWaitTime = 0.0
+        self.maxQueueWait = 0.0
+        self.maxQueueDepth = 0
+        self.workers = [ threading.Thread(target=self.runWorker, name="request worker", daemon=True) for _ in range(workerCount) ]
+        for worker in self.workers:
+            worker.start()
+
+    @classmethod
+    def create(cls, rcHandler, useThreads):
+        workerCount = rcHandler.getint("server_worker_threads", [ "general" ], 0)
+        if useThreads and workerCount > 0:
+            return cls(workerCount, rcHandler.getint("server_worker_queue_size", [ "general" ], 500))
+
+    def submit(self, method, *args):
+        # Blocks when the queue is full, so further connections wait in the listen backlog
+        self.requestQueue.put((method, args, time.perf_counter()))
+        with self.metricsLock:
+            self.maxQueueDepth = max(self.maxQueueDepth, self.requestQueue.qsize())
+
+    def runWorker(self):
+        while True:
+            item = self.requestQueue.get()
+            if item is None:
+                return
+            method, args, queuedTime = item
+            waitTime = time.perf_counter() - queuedTime
+            with self.metricsLock:
+                self.requestsHandled += 1
+                self.queueWaitTime += waitTime
+                self.maxQueueWait = max(self.maxQueueWait, waitTime)
+            try:
+                method(*args)
+            except Exception as e: # pragma: no cover - request handling catches its own errors
+                sys.stderr.write("WARNING: CaptureMock request worker failed: " + str(e) + "\n")
+
+    def getMetrics(self):
+        with self.metricsLock:
+            return { "handled" : self.requestsHandled, "wait_time" : self.queueWaitTime,
+                     "max_wait" : self.maxQueueWait, "max_depth" : self.maxQueueDepth }
+
+    def drain(self):
+        # Everything already queued is handled before the workers stop
+        for _ in self.workers:
+            self.requestQueue.put(None)
+        for worker in self.workers:
+            worker.join()
+        metrics = self.getMetrics()
+        logging.getLogger("Server").info("Request workers handled " + str(metrics["handled"]) + " requests, max queue depth " +
+                                         str(metrics["max_depth"]) + ", waited " + "%.3f" % metrics["wait_time"] +
+                                         " seconds in the queue, at most " + "%.3f" % metrics["max_wait"])
+
+
 class ClassicTrafficServer:    
     def __init__(self):
         self.terminate = False
         self.requestCount = 0
+        self.workerPool = None
         # Default value of 5 isn't very much...
         # There doesn't seem to be any disadvantage of allowing a longer queue, so we will increase it by a lot...
         self.request_queue_size = 500
@@ -123,9 +182,12 @@ class ClassicTrafficServer:
             self.handle_request()
         # Join all remaining request threads so they don't
         # execute after Python interpreter has started to shut itself down.
-        for t in threading.enumerate():
-            if t.name == "request":
-                t.join()
+        if self.workerPool:
+            self.workerPool.drain()
+        else:
+            for t in threading.enumerate():
+                if t.name == "request":
+                    t.join()
 
     def process_request_thread(self, request, client_address, requestCount):
         # Copied from ThreadingMixin, more or less
@@ -159,16 +221,20 @@ class ClassicTcpTrafficServer(ClassicTrafficServer, TCPServer):
     @classmethod
     def createServer(cls, address, port, dispatcher):
         ClassicTcpTrafficRequestHandler.dispatcher = dispatcher
-        return cls((address, port), ClassicTcpTrafficRequestHandler, dispatcher.useThreads)
+        workerPool = RequestWorkerPool.create(dispatcher.rcHandler, dispatcher.useThreads)
+        return cls((address, port), ClassicTcpTrafficRequestHandler, dispatcher.useThreads, workerPool)
 
-    def __init__(self, addrinfo, handlerClass, useThreads):
+    def __init__(self, addrinfo, handlerClass, useThreads, workerPool=None):
         ClassicTrafficServer.__init__(self)
         TCPServer.__init__(self, addrinfo, handlerClass)
         self.useThreads = useThreads
+        self.workerPool = workerPool
 
     def process_request(self, request, client_address):
         self.requestCount += 1
-        if self.useThreads:
+        if self.useThreads and self.workerPool:
+            self.workerPool.submit(self.process_request_thread, request, client_address, self.requestCount)
+        elif self.useThreads:
             """Start a new thread to process the request."""
             t = threading.Thread(target = self.process_request_thread, name="request",
                                  args = (request, client_address, self.requestCount))
@@ -269,6 +335,25 @@ class HTTPTrafficHandler(BaseHTTPRequestHandler):
     redirects = {}
     requestCount = 0
     redirectLock = threading.Lock()
+    requestCountLock = threading.Lock()
+    @classmethod
+    def configure(cls, dispatcher):
+        cls.dispatcher = dispatcher
+        if dispatcher.rcHandler.getboolean("http_keep_alive", [ "general" ], False):
+            # Clients can then send lots of requests on the same connection, closing it if it stays idle too long
+            cls.protocol_version = "HTTP/1.1"
+            cls.disable_nagle_algorithm = True
+            cls.timeout = dispatcher.rcHandler.getfloat("http_keep_alive_timeout", [ "general" ], 5.0)
+            return True
+        return False
+
+    @classmethod
+    def nextRequestNumber(cls):
+        # Handlers may run in several threads, each request must get its own number
+        with cls.requestCountLock:
+            cls.requestCount += 1
+            return cls.requestCount
+
     def read_data(self):
         # Lifted from https://stackoverflow.com/questions/60895110/how-to-handle-chunked-encoding-in-python-basehttprequesthandler
         # Weird that there is no builtin way to handle this
@@ -291,6 +376,17 @@ class HTTPTrafficHandler(BaseHTTPRequestHandler):
                 if chunk_length == 0:
                     return data
     
+    def end_empty_headers(self):
+        # Without it, a keep-alive client can't tell there is no body coming
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def process_traffic(self, traffic, requestNumber):
+        responses = self.dispatcher.process(traffic, requestNumber)
+        if not any(isinstance(response, clientservertraffic.HTTPServerTraffic) for response in responses):
+            # Nothing was sent back, closing the connection is the only way to tell the client
+            self.close_connection = True
+
     def log_message(self, format, *args):
         self.dispatcher.diag.debug(format % args)
         
@@ -365,23 +461,26 @@ class HTTPTrafficHandler(BaseHTTPRequestHandler):
                 print(self.path, file=sys.stderr)
                 print("target_id=", self.find_redirect_target_id(), file=sys.stderr)
                 self.send_response(404)
-            self.end_headers()
+            self.end_empty_headers()
             return True
         return False
 
     def do_GET(self):
+        # Must always read the request, or the next one on the same connection won't make sense
+        self.read_data()
         if self.path == "/capturemock/shutdownServer":
             self.send_response(200)
-            self.end_headers()
+            self.end_empty_headers()
+            self.close_connection = True
             self.dispatcher.server.setShutdownFlag()
         else:
             if self.try_redirect():
                 return
             
-            HTTPTrafficHandler.requestCount += 1
+            requestNumber = self.nextRequestNumber()
             traffic = clientservertraffic.HTTPClientTraffic(responseFile=self.wfile, method="GET", path=self.get_local_path(), headers=self.headers, 
                                                             rcHandler=self.dispatcher.rcHandler, handler=self)
-            self.dispatcher.process(traffic, self.requestCount)
+            self.process_traffic(traffic, requestNumber)
 
     def do_POST(self):
         rawbytes = self.read_data()        
@@ -396,7 +495,7 @@ class HTTPTrafficHandler(BaseHTTPRequestHandler):
                 else:
                     self.redirects[redirectKey] = mapping
             self.send_response(200)
-            self.end_headers()
+            self.end_empty_headers()
             return
         
         if self.try_redirect():
@@ -406,29 +505,29 @@ class HTTPTrafficHandler(BaseHTTPRequestHandler):
             rcFile = rawbytes.decode(getpreferredencoding())
             self.dispatcher.rcHandler.addFile(rcFile)
             self.send_response(200)
-            self.end_headers()
+            self.end_empty_headers()
             return
         
-        HTTPTrafficHandler.requestCount += 1
+        requestNumber = self.nextRequestNumber()
         if self.path == "/capturemock/setServerLocation":
             text = rawbytes.decode(getpreferredencoding())
             traffic = clientservertraffic.HTTPServerStateTraffic(text, rcHandler=self.dispatcher.rcHandler)
             self.send_response(200)
-            self.end_headers()
+            self.end_empty_headers()
         else:
             traffic = clientservertraffic.HTTPClientTraffic(rawbytes, self.wfile, method="POST", path=self.get_local_path(), headers=self.headers, 
                                                             rcHandler=self.dispatcher.rcHandler, handler=self)
-        self.dispatcher.process(traffic, self.requestCount)
+        self.process_traffic(traffic, requestNumber)
         
     def do_method_with_payload(self, method):
         # Must always read the request, even if redirecting
         rawbytes = self.read_data()
         if self.try_redirect():
             return
-        HTTPTrafficHandler.requestCount += 1
+        requestNumber = self.nextRequestNumber()
         traffic = clientservertraffic.HTTPClientTraffic(rawbytes, self.wfile, method=method, path=self.get_local_path(), headers=self.headers, 
                                                         rcHandler=self.dispatcher.rcHandler, handler=self)
-        self.dispatcher.process(traffic, self.requestCount)
+        self.process_traffic(traffic, requestNumber)
 
     def do_PATCH(self):
         self.do_method_with_payload("PATCH")
@@ -437,19 +536,20 @@ class HTTPTrafficHandler(BaseHTTPRequestHandler):
         self.do_method_with_payload("PUT")
         
     def do_DELETE(self):
+        self.read_data()
         if self.try_redirect():
             return
-        HTTPTrafficHandler.requestCount += 1
+        requestNumber = self.nextRequestNumber()
         traffic = clientservertraffic.HTTPClientTraffic(responseFile=self.wfile, method="DELETE", path=self.get_local_path(), headers=self.headers, 
                                                         rcHandler=self.dispatcher.rcHandler, handler=self)
-        self.dispatcher.process(traffic, self.requestCount)
+        self.process_traffic(traffic, requestNumber)
     
     def do_OPTIONS(self):
         self.send_response(200, "ok")
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header("Access-Control-Allow-Headers", '*')
         self.send_header('Access-Control-Allow-Methods', '*')
-        self.end_headers()
+        self.end_empty_headers()
         
         
         
@@ -457,17 +557,39 @@ class HTTPTrafficHandler(BaseHTTPRequestHandler):
 class HTTPTrafficServer(HTTPServer):
     @classmethod
     def createServer(cls, address, port, dispatcher):
-        HTTPTrafficHandler.dispatcher = dispatcher
-        return cls((address, port))
+        keepAlive = HTTPTrafficHandler.configure(dispatcher)
+        workerPool = RequestWorkerPool.create(dispatcher.rcHandler, dispatcher.useThreads)
+        if keepAlive and not workerPool:
+            sys.stderr.write("WARNING: http_keep_alive is set without server_worker_threads, " +
+                             "so only one client connection can be served at a time\n")
+        return cls((address, port), workerPool)
     
-    def __init__(self, address):
+    def __init__(self, address, workerPool=None):
         # Default value of 5 isn't very much...
         # There doesn't seem to be any disadvantage of allowing a longer queue, so we will increase it by a lot...
         self.request_queue_size = 500
+        self.workerPool = workerPool
         HTTPServer.__init__(self, address, HTTPTrafficHandler)
     
     def run(self):
         self.serve_forever()
+        if self.workerPool:
+            self.workerPool.drain()
+
+    def process_request(self, request, client_address):
+        if self.workerPool:
+            self.workerPool.submit(self.process_request_thread, request, client_address)
+        else:
+            HTTPServer.process_request(self, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        # As in ThreadingMixIn, the request numbers keep the record file in the order the requests arrived
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
 
     def getAddress(self):
         host, port = self.socket.getsockname()
@@ -566,7 +688,7 @@ class ServerDispatcherBase:
         BaseTraffic.preserveCr = self.rcHandler.getboolean("preserve_cr", [ "general" ], False)
         BaseTraffic.preserveLf = self.rcHandler.getboolean("preserve_lf", [ "general" ], False)
         self.replayInfo = ReplayInfo(options.mode, options.replay, self.rcHandler)
-        self.recordFileHandler = RecordFileHandler(options.record)
+        self.recordFileHandler = RecordFileHandler(options.record, self.rcHandler)
         self.topLevelForEdit = [] # contains only paths explicitly given. Always present.
         self.fileEditData = OrderedDict() # contains all paths, including subpaths of the above. Empty when replaying.
         self.hasAsynchronousEdits = False
@@ -574,6 +696,17 @@ class ServerDispatcherBase:
         
     def getServerClass(self):
         protocol = self.rcHandler.get("server_protocol", [ "general" ], "classic")
+        engine = self.rcHandler.get("server_engine", [ "general" ], "socketserver")
+        if engine == "asyncio":
+            from capturemock import asyncserver
+            if protocol in [ "classic", "classic_tcp" ]:
+                return asyncserver.AsyncClassicTcpTrafficServer
+            elif protocol == "http":
+                return asyncserver.AsyncHTTPTrafficServer
+            else:
+                raise RuntimeError("server_engine 'asyncio' only supports the classic TCP and http protocols, not " + repr(protocol))
+        elif engine != "socketserver":
+            raise RuntimeError("Unknown server_engine " + repr(engine) + ", must be one of socketserver, asyncio")
         if protocol in [ "classic", "classic_tcp" ]:
             return ClassicTcpTrafficServer
         elif protocol == "classic_udp":
@@ -662,15 +795,17 @@ class ServerDispatcherBase:
                 return cls(value, wfile, self.rcHandler)
 
     def process(self, traffic, reqNo):
-        if not self.replayInfo.isActiveFor(traffic):
-            # If we're recording, check for file changes before we do
-            # Must do this before as they may be a side effect of whatever it is we're processing
-            for fileTraffic in self.getLatestFileEdits(self.topLevelForEdit, self.fileEditData):
-                self._process(fileTraffic, reqNo)
-
-        responses = self._process(traffic, reqNo)
-        self.recordFileHandler.requestComplete(reqNo)
-        return responses
+        try:
+            if not self.replayInfo.isActiveFor(traffic):
+                # If we're recording, check for file changes before we do
+                # Must do this before as they may be a side effect of whatever it is we're processing
+                for fileTraffic in self.getLatestFileEdits(self.topLevelForEdit, self.fileEditData):
+                    self._process(fileTraffic, reqNo)
+
+            return self._process(traffic, reqNo)
+        finally:
+            # Even if it failed, or later requests would wait for it forever to be recorded
+            self.recordFileHandler.requestComplete(reqNo)
 
     def _process(self, traffic, reqNo):
         self.diag.debug("Processing traffic " + traffic.__class__.__name__ + " with text " + repr(traffic.text))
@@ -858,6 +993,7 @@ class ServerDispatcher(ServerDispatcherBase):
     def run(self):
         self.diag.debug("Starting capturemock server at " + self.server.getAddress())
         self.server.run()
+        self.recordFileHandler.close()
         self.diag.debug("Shut down capturemock server")
         
     def shutdown(self):
@@ -921,6 +1057,7 @@ class ReplayOnlyDispatcher(ServerDispatcherBase):
                     self.diag.debug("Adding ID mapping from " + replay_id + " to " + currId)
                     alterations[replay_id] = currId
                     self.add_id_mapping(traffic, replay_id, currId)
+        self.recordFileHandler.close()
         self.diag.debug("Replaying all now complete")
         if alterations:
             id_mapping.make_id_alterations_rc_file(alterations)
@@ -936,41 +1073,111 @@ class ReplayOnlyDispatcher(ServerDispatcherBase):
 # file in the order in which it comes in, not in the order in which it completes (which is indeterministic and
 # may be wrong next time around)
 class RecordFileHandler(recordfilehandler.RecordFileHandler):
-    def __init__(self, file):
-        super(RecordFileHandler, self).__init__(file)
+    def __init__(self, file, rcHandler=None):
+        super(RecordFileHandler, self).__init__(file, rcHandler)
         self.recordingRequest = 1
         self.cache = {}
-        self.completedRequests = []
+        self.completedRequests = set()
         self.lock = threading.Lock()
+        self.writerQueue = None
+        self.writerThread = None
+        self.metricsLock = threading.Lock()
+        self.itemsQueued = 0
+        self.queueWaits = 0
+        self.queueWaitTime = 0.0
+        self.maxQueueDepth = 0
+        if file and rcHandler and rcHandler.getboolean("record_writer_thread", [ "general" ], False):
+            # Request threads just hand over what they have, a single thread does the ordering and the disk writes
+            self.writerQueue = queue.Queue(rcHandler.getint("record_writer_queue_size", [ "general" ], 1000))
+            self.writerThread = threading.Thread(target=self.runWriter, name="record writer", daemon=True)
+            self.writerThread.start()
 
     def requestComplete(self, requestNumber):
+        if self.writerQueue is not None:
+            self.enqueue(self.orderRequestComplete, requestNumber)
+        else:
+            self.orderRequestComplete(requestNumber)
+
+    def record(self, text, requestNumber):
+        if self.writerQueue is not None:
+            self.enqueue(self.orderRecord, text, requestNumber)
+        else:
+            self.orderRecord(text, requestNumber)
+
+    def enqueue(self, method, *args):
+        item = method, args
+        try:
+            self.writerQueue.put_nowait(item)
+            waitTime = None
+        except queue.Full:
+            # The writer can't keep up, so the requests have to wait for the disk
+            startTime = time.perf_counter()
+            self.writerQueue.put(item)
+            waitTime = time.perf_counter() - startTime
+        with self.metricsLock:
+            self.itemsQueued += 1
+            if waitTime is not None:
+                self.queueWaits += 1
+                self.queueWaitTime += waitTime
+            self.maxQueueDepth = max(self.maxQueueDepth, self.writerQueue.qsize())
+
+    def runWriter(self):
+        while True:
+            item = self.writerQueue.get()
+            if item is None:
+                return
+            method, args = item
+            try:
+                method(*args)
+            except Exception as e:
+                sys.stderr.write("WARNING: failed to write to record file " + repr(self.file) + ": " + str(e) + "\n")
+
+    def getWriterMetrics(self):
+        with self.metricsLock:
+            return { "queued" : self.itemsQueued, "waits" : self.queueWaits,
+                     "wait_time" : self.queueWaitTime, "max_depth" : self.maxQueueDepth }
+
+    def close(self):
+        if self.writerQueue is not None:
+            self.writerQueue.put(None)
+            self.writerThread.join()
+            self.writerQueue = None
+            metrics = self.getWriterMetrics()
+            logging.getLogger("Server").info("Record writer queued " + str(metrics["queued"]) + " items, max depth " +
+                                             str(metrics["max_depth"]) + ", requests waited " + str(metrics["waits"]) +
+                                             " times for " + "%.3f" % metrics["wait_time"] + " seconds")
+        super(RecordFileHandler, self).close()
+
+    def orderRequestComplete(self, requestNumber):
         self.lock.acquire()
         if requestNumber == self.recordingRequest:
             self.recordingRequestComplete()
+            self.flushAtRequestEnd()
         else:
-            self.completedRequests.append(requestNumber)
+            self.completedRequests.add(requestNumber)
         self.lock.release()
 
     def writeFromCache(self):
-        text = self.cache.get(self.recordingRequest)
-        if text:
-            super(RecordFileHandler, self).record(text)
-            del self.cache[self.recordingRequest]
+        chunks = self.cache.pop(self.recordingRequest, None)
+        if chunks:
+            super(RecordFileHandler, self).record("".join(chunks))
 
     def recordingRequestComplete(self):
-        self.writeFromCache()
-        self.recordingRequest += 1
-        if self.recordingRequest in self.completedRequests:
-            self.recordingRequestComplete()
+        # Loop rather than recurse, there can be a long run of requests that already finished
+        while True:
+            self.writeFromCache()
+            self.recordingRequest += 1
+            if self.recordingRequest not in self.completedRequests:
+                return
+            self.completedRequests.remove(self.recordingRequest)
 
-    def record(self, text, requestNumber):
+    def orderRecord(self, text, requestNumber):
         self.lock.acquire()
         if requestNumber == self.recordingRequest:
             self.writeFromCache()
             super(RecordFileHandler, self).record(text)
         else:
-            self.cache.setdefault(requestNumber, "")
-            self.cache[requestNumber] += text
+            self.cache.setdefault(requestNumber, []).append(text)
         self.lock.release()
 
 
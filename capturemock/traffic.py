@@ -1,31 +1,26 @@
 """ Defining the base traffic class which the useful traffic classes inherit """
 
 import re
-import os
 import sys
 from datetime import datetime
 
 from pprint import pformat
-try:
-    from collections import OrderedDict
-except ImportError:
-    from ordereddict import OrderedDict
+from capturemock.alterations import AlterationDict
 
 class BaseTraffic(object):
-    alterationVariables = OrderedDict()
+    alterationVariables = AlterationDict()
     preserveCr = False
     preserveLf = False
+    # (replay ID, record ID) once replaying has found one, for responses that aren't just text
+    replayIdMapping = None
     def __init__(self, text, rcHandler=None, timestamp=None):
         self.text = text
         self.timestamp = timestamp
-        self.alterations = {}
+        self.alterations = AlterationDict()
         if rcHandler:
             self.diag = rcHandler.diag
-            for alterStr in rcHandler.getList("alterations", self.getAlterationSectionNames()):
-                toFind = os.path.expandvars(rcHandler.get("match_pattern", [ alterStr ]))
-                toReplace = rcHandler.getWithAddress("replacement", [ alterStr ])
-                if toFind and toReplace is not None:
-                    self.alterations[re.compile(toFind)] = toReplace
+            # Shared with other traffic using the same sections, don't modify it
+            self.alterations = rcHandler.getAlterations(self.getAlterationSectionNames())
         
     @classmethod
     def get_timestamp(cls, rcHandler):                
@@ -43,20 +38,11 @@ class BaseTraffic(object):
         return self._applyAlterations(text, self.alterationVariables)
 
     def _applyAlterations(self, text, alterations):
-        class AlterationReplacer:
-            def __init__(rself, repl): #@NoSelf
-                rself.repl = repl
-
-            def __call__(rself, match): #@NoSelf
-                if rself.repl.startswith("$"):
-                    return self.storeAlterationVariable(rself.repl, match.group(0))
-                else:
-                    return match.expand(rself.repl)
-
         # Reverse it for the alteration variables, we may add newer ones as we go along, want to check those first...
-        for regex, repl in reversed(list(alterations.items())):
-            text = regex.sub(AlterationReplacer(repl), text)
-        return text
+        # The engine applies them in reverse order, and only bothers with those that match
+        if len(alterations) == 0:
+            return text
+        return alterations.getEngine().apply(text, lambda repl: AlterationReplacer(self, repl))
 
     @staticmethod
     def findNextNameCandidate(name):
@@ -193,3 +179,15 @@ class Traffic(BaseTraffic):
 
 class ResponseTraffic(Traffic):
     direction = "->"
+
+
+class AlterationReplacer:
+    def __init__(self, traffic, repl):
+        self.traffic = traffic
+        self.repl = repl
+
+    def __call__(self, match):
+        if self.repl.startswith("$"):
+            return self.traffic.storeAlterationVariable(self.repl, match.group(0))
+        else:
+            return match.expand(self.repl)